@@ -6,8 +6,9 @@ __author__ = "Mads Meisner-Jensen"
 import os
 import argparse
 import shutil
+import time
 
-from repomaker import GitRepo, GitRepoServer, Log
+from repomaker import GitRepo, GitRepoServer, Log, TmpfsStorage
 
 
 # default logger instance for repo operations
@@ -15,14 +16,14 @@ from repomaker import GitRepo, GitRepoServer, Log
 log = Log(level=1)
 
 
-def make_repo_abc(server_root, name, logger=log):
+def make_repo_abc(server_root, name, logger=log, storage=None):
     """
     Example of how to create a repo programmatically
     """
     # create some repo on the server
     path = f"{server_root}/{name}"
 
-    r = GitRepo(path, logger=logger).init()
+    r = GitRepo(path, logger=logger, storage=storage).init()
     r.config_write_user(force=True)
     r.file_add("a", text="this is a file"). \
         commit(message="first commit"). \
@@ -43,7 +44,7 @@ def make_repo_abc(server_root, name, logger=log):
     return r
 
 
-def example_testcase():
+def example_testcase(storage=None):
     """
     Example showing how to use repomaker in a testcase.
     In the steps below, "TEST" means what the test framework does
@@ -58,13 +59,13 @@ def example_testcase():
     """
     server_log = Log(level=1)
     server_root = "/tmp/reposerver"
-    server = GitRepoServer(server_root, logger=server_log)
+    server = GitRepoServer(server_root, logger=server_log, storage=storage)
     server.delete_repos()
     server.start()
 
     name = "abc"
     # make a repo on the server
-    repo = make_repo_abc(server.root_dir, name=name)
+    repo = make_repo_abc(server.root_dir, name=name, storage=server.storage)
     # Get the full reflog of the created repo
     reflog = repo.reflog()
 
@@ -94,12 +95,48 @@ def example_testcase():
     for e in entries:
         print(e)
 
+def example_pack_maintenance(num_commits=500):
+    """
+    Example showing the effect of pack maintenance on the server repos,
+    by timing a clone before and after GitRepoServer.pack_maintenance()
+    """
+    server_log = Log(level=0)
+    server_root = "/tmp/reposerver"
+    server = GitRepoServer(server_root, logger=server_log)
+    server.delete_repos()
+    server.start()
+
+    # build a repo with lots of loose objects
+    name = "many"
+    r = GitRepo(f"{server.root_dir}/{name}").init()
+    for i in range(num_commits):
+        r.file_add(f"dir{i % 10}/file{i}", text=f"contents of file {i}\n" * 100). \
+            commit(message=f"commit {i}")
+
+    def time_clone():
+        os.chdir("/tmp")
+        shutil.rmtree(name, ignore_errors=True)
+        time_started = time.time()
+        GitRepo.create_from_clone(server.URL_BASE, name)
+        return time.time() - time_started
+
+    elapsed_before = time_clone()
+    server.pack_maintenance()
+    elapsed_after = time_clone()
+    log.info(f"clone of {num_commits} commits: {elapsed_before:.3f}s before and "
+             f"{elapsed_after:.3f}s after pack maintenance")
+
+
 def parser_create():
     description = f"""\
 Run example of how to use GitRepo and GitRepoServer classes
 """
     parser = argparse.ArgumentParser(
         description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pack', action='store_true',
+                        help="Time a clone before and after server pack maintenance")
+    parser.add_argument('--tmpfs', action='store_true',
+                        help="Place server repos on tmpfs (/dev/shm)")
 
     return parser
 
@@ -108,7 +145,11 @@ def main():
     parser = parser_create()
     opt = parser.parse_args()
 
-    example_testcase()
+    if opt.pack:
+        example_pack_maintenance()
+    else:
+        storage = TmpfsStorage(logger=log) if opt.tmpfs else None
+        example_testcase(storage=storage)
 
 
 if __name__ == "__main__":
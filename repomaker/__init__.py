@@ -1,3 +1,5 @@
 from .log import Ansi, Log
 from .repo.gitrepo import GitRepo
+from .repo.repostate import RepoState
 from .reposerver import GitRepoServer
+from .storage import TmpfsStorage
@@ -0,0 +1,187 @@
+"""
+Streaming parser of the `git daemon --verbose` logfile with per-repo metrics
+"""
+import re
+import threading
+import time
+
+
+# Log lines of interest, e.g.:
+#   [13926] Connection from 127.0.0.1:45282
+#   [13926] Request upload-pack for '/many'
+#   [11411] [13926] Disconnected
+#   [11411] [13927] Disconnected (with error)
+_CONNECTION_RE = re.compile(r"^\[(\d+)\] Connection from (\S+)$")
+_REQUEST_RE = re.compile(r"^\[(\d+)\] Request (\S+) for '([^']*)'$")
+_DISCONNECTED_RE = re.compile(r"\[(\d+)\] Disconnected( \(with error\))?$")
+
+
+class RepoMetrics(object):
+    """
+    Request metrics of a single repo (or of all repos)
+    """
+
+    def __init__(self):
+        # number of requests per service, e.g. {'upload-pack': 10}
+        self.requests = {}
+        # number of requests in progress
+        self.active = 0
+        # max number of concurrent requests seen
+        self.max_active = 0
+        # number of requests that ended with an error
+        self.errors = 0
+        # number of ended requests and their total and max duration
+        self.completed = 0
+        self.duration_total = 0.0
+        self.duration_max = 0.0
+
+    def begin(self, service):
+        self.requests[service] = self.requests.get(service, 0) + 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+
+    def end(self, duration, error):
+        self.active -= 1
+        self.completed += 1
+        self.errors += int(error)
+        self.duration_total += duration
+        self.duration_max = max(self.duration_max, duration)
+
+    def as_dict(self):
+        return {
+            "requests": dict(self.requests),
+            "active": self.active,
+            "max_active": self.max_active,
+            "errors": self.errors,
+            "completed": self.completed,
+            "duration_total": self.duration_total,
+            "duration_mean": self.duration_total / self.completed if self.completed else 0.0,
+            "duration_max": self.duration_max,
+        }
+
+
+class GitDaemonLog(object):
+    """
+    Follow a git daemon logfile incrementally and aggregate request metrics.
+
+    The logfile is read from the saved offset on every poll(), so only new
+    lines are parsed. As the daemon does not timestamp its log lines, the
+    time a line is parsed is used as the event time. Thus durations are only
+    as precise as the poll interval, see follow().
+    """
+
+    def __init__(self, logfile):
+        """
+        :param logfile: Path of git daemon logfile
+        """
+        self.logfile = logfile
+        self.lock = threading.Lock()
+        self.reset()
+
+        # background follower thread (see follow())
+        self._follower = None
+        self._follower_stop = threading.Event()
+
+    def reset(self):
+        """
+        Forget all metrics and restart parsing from the start of the logfile
+        """
+        # offset in logfile of next line to parse
+        self.offset = 0
+        # number of connections
+        self.connections = 0
+        # per-pid state of connections in progress: pid -> (start time, repo)
+        self.pids = {}
+        # metrics of all requests
+        self.total = RepoMetrics()
+        # metrics per repo
+        self.repos = {}
+
+    def poll(self):
+        """
+        Parse all complete lines appended to the logfile since last poll
+
+        :return: number of lines parsed
+        """
+        with self.lock:
+            try:
+                with open(self.logfile, "rb") as f:
+                    f.seek(self.offset)
+                    data = f.read()
+            except FileNotFoundError:
+                return 0
+
+            # leave partial last line for next poll
+            end = data.rfind(b"\n") + 1
+            lines = data[:end].decode("utf8", errors="replace").splitlines()
+            self.offset += end
+
+            now = time.time()
+            for line in lines:
+                self._parse_line(line, now)
+
+            return len(lines)
+
+    def _parse_line(self, line, now):
+        m = _CONNECTION_RE.match(line)
+        if m:
+            self.connections += 1
+            self.pids[m.group(1)] = (now, None)
+            return
+
+        m = _REQUEST_RE.match(line)
+        if m:
+            pid, service, repo = m.groups()
+            started, _ = self.pids.get(pid, (now, None))
+            self.pids[pid] = (started, repo)
+            self.total.begin(service)
+            self.repos.setdefault(repo, RepoMetrics()).begin(service)
+            return
+
+        m = _DISCONNECTED_RE.search(line)
+        if m:
+            started, repo = self.pids.pop(m.group(1), (None, None))
+            if repo is not None:
+                error = m.group(2) is not None
+                self.total.end(now - started, error)
+                self.repos[repo].end(now - started, error)
+
+    def snapshot(self):
+        """
+        Parse new log lines and return the current metrics
+
+        :return: dict with total metrics and metrics per repo
+        """
+        self.poll()
+        with self.lock:
+            return {
+                "connections": self.connections,
+                "total": self.total.as_dict(),
+                "repos": {repo: m.as_dict() for repo, m in self.repos.items()},
+            }
+
+    def follow(self, interval=0.05):
+        """
+        Start a background thread that polls the logfile every `interval` seconds
+
+        :param interval: poll interval in seconds
+        """
+        if self._follower:
+            return
+
+        def follower():
+            while not self._follower_stop.wait(interval):
+                self.poll()
+
+        self._follower_stop.clear()
+        self._follower = threading.Thread(target=follower, name="git-daemon-log", daemon=True)
+        self._follower.start()
+
+    def unfollow(self):
+        """
+        Stop the background thread started by follow()
+        """
+        if self._follower:
+            self._follower_stop.set()
+            self._follower.join()
+            self._follower = None
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Export and import of the repos of a git server as a single artifact, such
+that a set of repos (a fixture) is built once and distributed to other hosts
+
+Example:
+
+    python3 -m repomaker.fixture export /tmp/reposerver /shared/fixture.tar
+    python3 -m repomaker.fixture import /shared/fixture.tar /tmp/reposerver
+
+The artifact is a tar file with a manifest (manifest.json, the first member)
+and a 'git bundle' of each repo. Bundles contain packfiles, which are already
+compressed, so the tar file is not compressed again by default.
+
+Only refs and the objects reachable from them are exported, not the config,
+reflogs or uncommitted changes of a repo.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .log import Log
+from .repo.baserepo import RepoError
+from .repo.gitrepo import GitRepo
+from .reposerver import GitRepoServer
+
+
+# Version of the artifact format
+FORMAT_VERSION = 1
+
+MANIFEST_NAME = "manifest.json"
+
+
+def _sha256_file(path, bufsize=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(bufsize), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _repo_refs(repo):
+    """
+    Return dict of ref name -> object id of all refs of `repo`
+    """
+    out = repo.run_command(["for-each-ref", "--format=%(objectname) %(refname)"])
+    return dict(reversed(line.split(" ", 1)) for line in out.splitlines())
+
+
+def _export_repo(repo, bundle_path):
+    """
+    Write bundle of all refs of `repo` to `bundle_path` and return its manifest entry
+    """
+    bare = repo.run_command(["rev-parse", "--is-bare-repository"]) == "true"
+    head = repo.run_command(["symbolic-ref", "-q", "HEAD"], assert_ok=False) or \
+        repo.run_command(["rev-parse", "HEAD"])
+    refs = _repo_refs(repo)
+
+    entry = {"bare": bare, "head": head, "refs": refs, "bundle": None, "sha256": None, "size": 0}
+    if refs:
+        # 'git bundle' refuses to create empty bundles
+        repo.run_command(["bundle", "create", "-q", bundle_path, "--all"])
+        entry.update(bundle=os.path.basename(bundle_path), sha256=_sha256_file(bundle_path),
+                     size=os.path.getsize(bundle_path))
+    return entry
+
+
+def export_repos(server, artifact, repos=None, jobs=None, compression=None):
+    """
+    Export repos of `server` to `artifact`. Bundles are created in parallel.
+
+    :param server: GitRepoServer instance (need not be running)
+    :param artifact: path of artifact to write (replaced atomically)
+    :param repos: repo paths (relative to server root), None for all repos
+    :param jobs: max number of repos to process in parallel (default is number of CPUs)
+    :param compression: None, "gz", "bz2" or "xz"
+    :return: manifest dict
+    """
+    if repos is None:
+        repos = server.find_repos()
+
+    server.log.info(f"{server} exporting {len(repos)} repos to {artifact}")
+    time_started = time.time()
+
+    with tempfile.TemporaryDirectory(prefix="repomaker-export-") as tmp_dir:
+        def export(item):
+            i, path = item
+            repo = GitRepo(str(Path(server.root_dir) / path), logger=server.log)
+            entry = _export_repo(repo, os.path.join(tmp_dir, f"{i}.bundle"))
+            entry["path"] = path
+            return entry
+
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+            entries = list(executor.map(export, enumerate(repos)))
+
+        manifest = {"version": FORMAT_VERSION, "repos": entries}
+        data = json.dumps(manifest, indent=1, sort_keys=True).encode()
+
+        tmp_artifact = f"{artifact}.tmp"
+        mode = f"w:{compression}" if compression else "w"
+        with tarfile.open(tmp_artifact, mode) as tar:
+            info = tarfile.TarInfo(MANIFEST_NAME)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+            for entry in entries:
+                if entry["bundle"]:
+                    tar.add(os.path.join(tmp_dir, entry["bundle"]), arcname=entry["bundle"])
+        os.replace(tmp_artifact, artifact)
+
+    elapsed = time.time() - time_started
+    server.log.info(f"{server} exported {len(repos)} repos in {elapsed:.1f}s")
+    return manifest
+
+
+def _check_entry(entry, artifact):
+    """
+    Raise RepoError if manifest `entry` has a path that would escape the
+    server root or a bundle name that is not a plain file name, as the
+    artifact may come from untrusted storage
+    """
+    path = entry.get("path")
+    if not isinstance(path, str) or not path or os.path.isabs(path) or "\\" in path \
+            or any(part in ("", ".", "..") for part in path.split("/")):
+        raise RepoError(f"invalid repo path {path!r} in {artifact}")
+
+    bundle = entry.get("bundle")
+    if bundle is not None and (not isinstance(bundle, str) or bundle in ("", ".", "..", MANIFEST_NAME)
+                               or os.path.basename(bundle) != bundle or "\\" in bundle):
+        raise RepoError(f"invalid bundle name {bundle!r} of {path} in {artifact}")
+
+
+def _import_repo(server, entry, bundle_path, overwrite):
+    """
+    Create repo of manifest `entry` on `server` from `bundle_path` and
+    verify that its refs match the manifest
+    """
+    path = str(Path(server.root_dir) / entry["path"])
+    if os.path.lexists(path):
+        if not overwrite:
+            raise RepoError(f"cannot import {entry['path']}: {path} exists")
+        if server.storage and server.storage.is_allocated(path):
+            server.storage.release(path)
+        else:
+            shutil.rmtree(path)
+
+    repo = GitRepo(path, logger=server.log, storage=server.storage)
+    if server.storage:
+        server.storage.allocate(path)
+    else:
+        os.makedirs(path)
+    repo.run_command(["init", "-q"] + (["--bare"] if entry["bare"] else []))
+    if server.storage:
+        server.storage.configure(repo)
+
+    if bundle_path:
+        # fetch into all refs, including the (unborn) current branch
+        repo.run_command(["fetch", "-q", "--update-head-ok", bundle_path, "+refs/*:refs/*"])
+
+    head = entry["head"]
+    if head.startswith("refs/"):
+        repo.run_command(["symbolic-ref", "HEAD", head])
+    else:
+        repo.run_command(["update-ref", "--no-deref", "HEAD", head])
+
+    refs = _repo_refs(repo)
+    if refs != entry["refs"]:
+        raise RepoError(f"refs of imported repo {entry['path']} do not match the manifest")
+
+    if not entry["bare"] and refs:
+        repo.run_command(["reset", "-q", "--hard"])
+
+    return entry["path"]
+
+
+def import_repos(server, artifact, repos=None, jobs=None, overwrite=False):
+    """
+    Import repos from `artifact` to `server`. Bundles are verified against
+    the hashes in the manifest while they are extracted, and repos are
+    created from them in parallel with the extraction.
+
+    :param server: GitRepoServer instance (need not be running), repos are
+                   placed on its storage backend (if any)
+    :param artifact: path of artifact written by export_repos()
+    :param repos: repo paths to import, None for all repos in the artifact
+    :param jobs: max number of repos to process in parallel (default is number of CPUs)
+    :param overwrite: True to replace existing repos, else RepoError is raised
+    :return: list of imported repo paths
+    """
+    server.log.info(f"{server} importing repos from {artifact}")
+    time_started = time.time()
+
+    # "r:*" detects compression, tar members are read in order
+    with tarfile.open(artifact, "r:*") as tar, \
+            tempfile.TemporaryDirectory(prefix="repomaker-import-") as tmp_dir, \
+            ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        member = tar.next()
+        if member is None or member.name != MANIFEST_NAME:
+            raise RepoError(f"{artifact} is not a repo fixture: {MANIFEST_NAME} is missing")
+        manifest = json.load(tar.extractfile(member))
+        if manifest.get("version") != FORMAT_VERSION:
+            raise RepoError(f"{artifact} has unsupported format version {manifest.get('version')}")
+
+        entries = manifest["repos"]
+        for entry in entries:
+            _check_entry(entry, artifact)
+        if repos is not None:
+            entries = [e for e in entries if e["path"] in repos]
+            missing = set(repos) - {e["path"] for e in entries}
+            if missing:
+                raise RepoError(f"repos not in {artifact}: {', '.join(sorted(missing))}")
+
+        futures = [executor.submit(_import_repo, server, e, None, overwrite)
+                   for e in entries if not e["bundle"]]
+        by_bundle = {e["bundle"]: e for e in entries if e["bundle"]}
+
+        for member in tar:
+            entry = by_bundle.pop(member.name, None)
+            if entry is None:
+                continue
+            bundle_path = os.path.join(tmp_dir, member.name)
+            sha = hashlib.sha256()
+            with tar.extractfile(member) as src, open(bundle_path, "wb") as dst:
+                for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                    sha.update(chunk)
+                    dst.write(chunk)
+            if sha.hexdigest() != entry["sha256"]:
+                raise RepoError(f"bundle of {entry['path']} in {artifact} is corrupt (hash mismatch)")
+            futures.append(executor.submit(_import_repo, server, entry, bundle_path, overwrite))
+
+        if by_bundle:
+            missing = ", ".join(sorted(e["path"] for e in by_bundle.values()))
+            raise RepoError(f"bundles missing from {artifact}: {missing}")
+
+        # result() re-raises the first exception from any of the workers
+        imported = [future.result() for future in futures]
+
+    elapsed = time.time() - time_started
+    server.log.info(f"{server} imported {len(imported)} repos in {elapsed:.1f}s")
+    return sorted(imported)
+
+
+def parser_create():
+    description = """\
+Export repos of a git server root to a single artifact of git bundles and
+a manifest, or import repos from such an artifact (verified and in parallel).
+"""
+    parser = argparse.ArgumentParser(
+        description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="Number of repos to process in parallel (default is number of CPUs)")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Be more verbose")
+    # (required=True needs Python 3.7, the command is checked in main())
+    sub = parser.add_subparsers(dest="command")
+
+    p = sub.add_parser("export", help="Export repos in ROOT to ARTIFACT")
+    p.add_argument("root")
+    p.add_argument("artifact")
+    p.add_argument('--repo', action='append', dest='repos',
+                   help="Repo to export (can be repeated). Default is all repos in ROOT")
+    p.add_argument('--compression', choices=["gz", "bz2", "xz"],
+                   help="Compress artifact (default is no compression, bundles are compressed)")
+
+    p = sub.add_parser("import", help="Import repos from ARTIFACT to ROOT")
+    p.add_argument("artifact")
+    p.add_argument("root")
+    p.add_argument('--repo', action='append', dest='repos',
+                   help="Repo to import (can be repeated). Default is all repos in ARTIFACT")
+    p.add_argument('--overwrite', action='store_true',
+                   help="Replace existing repos")
+
+    return parser
+
+
+def main():
+    parser = parser_create()
+    opt = parser.parse_args()
+    if not opt.command:
+        parser.error("a command is required")
+    log = Log(level=opt.verbose)
+
+    server = GitRepoServer(opt.root, logger=log, watchdog_interval=None)
+    if opt.command == "export":
+        manifest = export_repos(server, opt.artifact, repos=opt.repos, jobs=opt.jobs,
+                                compression=opt.compression)
+        print(f"exported {len(manifest['repos'])} repos to {opt.artifact}")
+    else:
+        repos = import_repos(server, opt.artifact, repos=opt.repos, jobs=opt.jobs,
+                             overwrite=opt.overwrite)
+        print(f"imported {len(repos)} repos to {opt.root}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Load generator running concurrent git clients against a git server
+
+Example:
+
+    python3 -m repomaker.loadgen --server-root /tmp/reposerver --duration 10
+    python3 -m repomaker.loadgen --url-base git://localhost --repo abc --mix fetch=3,push=1
+"""
+import argparse
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from . import run
+from .log import Log
+from .repo.gitrepo import GitRepo
+from .reposerver import GitRepoServer
+
+
+def process_cpu_time(pid):
+    """
+    Return CPU time (in seconds) used by process `pid` and all its descendants,
+    both live and exited (reaped) ones, e.g. of a git server (see
+    run.process_tree()).
+
+    Only supported on Linux.
+
+    :param pid: process id
+    :return: CPU time in seconds or None if not available
+    """
+    tree = run.process_tree(pid)
+    if not tree:
+        return None
+
+    # utime, stime, cutime, cstime are fields 14-17
+    ticks = sum(int(v) for fields in tree.values() for v in fields[11:15])
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values, pct):
+    """
+    Return the `pct` percentile of sorted `values` (nearest-rank method)
+    """
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+class LoadReport(object):
+    """
+    Result of a LoadGenerator run
+    """
+
+    def __init__(self):
+        # per-operation list of latencies of successful requests
+        self.latencies = {}
+        # per-operation number of failed requests
+        self.errors = {}
+        # wall clock duration of the run
+        self.elapsed = 0.0
+        # CPU time used by the server during the run (None if unknown)
+        self.server_cpu = None
+        # per-service number of requests handled according to the server log
+        self.server_requests = {}
+
+    def add(self, op, latency, ok):
+        if ok:
+            self.latencies.setdefault(op, []).append(latency)
+        else:
+            self.errors[op] = self.errors.get(op, 0) + 1
+
+    @property
+    def num_requests(self):
+        return sum(len(v) for v in self.latencies.values()) + sum(self.errors.values())
+
+    @property
+    def throughput(self):
+        return self.num_requests / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        """
+        Return report as human readable multiline string
+        """
+        lines = [f"{self.num_requests} requests in {self.elapsed:.1f}s = {self.throughput:.1f} req/s"]
+        lines.append(f"{'op':<10} {'count':>7} {'errors':>7} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+        for op in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies.get(op, []))
+            errors = self.errors.get(op, 0)
+            count = len(values) + errors
+            pcts = [percentile(values, p) * 1000 for p in (50, 90, 99, 100)]
+            lines.append(f"{op:<10} {count:>7} {errors / count:>7.1%} " +
+                         " ".join(f"{v:>6.1f}ms" for v in pcts))
+
+        if self.server_cpu is not None:
+            cpu_load = self.server_cpu / self.elapsed if self.elapsed else 0.0
+            lines.append(f"server CPU {self.server_cpu:.2f}s ({cpu_load:.0%} of one core)")
+        if self.server_requests:
+            requests = ", ".join(f"{k}={v}" for k, v in sorted(self.server_requests.items()))
+            lines.append(f"server log requests: {requests}")
+
+        return "\n".join(lines)
+
+
+class LoadGenerator(object):
+    """
+    Run a mix of concurrent clone, fetch, ls-remote and push clients
+    from a pool of worker threads against repos on a git server.
+
+    Each worker has its own scratch directory with clones used for fetch
+    and push. Pushes go to a branch private to the worker.
+    """
+
+    # The default weights of the operations
+    MIX = {"clone": 1, "fetch": 4, "ls-remote": 4, "push": 1}
+
+    def __init__(self, url_base, repos, mix=None, workers=8, server=None, logger=None):
+        """
+        :param url_base:  URL base of server, e.g. git://localhost
+        :param repos:     repo names (paths relative to url_base) to use
+        :param mix:       dict of operation name and weight (default is LoadGenerator.MIX)
+        :param workers:   number of concurrent clients
+        :param server:    GitRepoServer instance serving the repos (used for server stats)
+        :param logger:    Log instance
+        """
+        self.url_base = url_base
+        self.repos = list(repos)
+        self.mix = mix or LoadGenerator.MIX
+        self.workers = workers
+        self.server = server
+        self.log = logger or Log(level=-1)
+
+        for op in self.mix:
+            if not hasattr(self, self._op_method(op)):
+                raise ValueError(f"unknown operation '{op}'")
+
+    @staticmethod
+    def _op_method(op):
+        return "op_" + op.replace("-", "_")
+
+    def _git(self, *args):
+        cmd = ["git"] + [str(arg) for arg in args]
+        exitcode, _, err = run.cmd_run(cmd)
+        if exitcode != 0:
+            self.log.debug(f"{run.cmd_str(cmd)} failed: {err.strip()}")
+        return exitcode == 0
+
+    def _ensure_clone(self, scratch, repo):
+        """Return path of worker clone of `repo` (cloned on first use)"""
+        path = Path(scratch) / "clones" / repo
+        if not path.is_dir():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if not self._git("clone", "-q", f"{self.url_base}/{repo}", path):
+                return None
+            GitRepo(str(path)).config_write_user()
+        return path
+
+    ###########################################################################
+    # Operations
+    # Each returns True on success
+    ###########################################################################
+
+    def op_clone(self, scratch, worker, repo):
+        path = Path(scratch) / "clone"
+        shutil.rmtree(path, ignore_errors=True)
+        return self._git("clone", "-q", f"{self.url_base}/{repo}", path)
+
+    def op_fetch(self, scratch, worker, repo):
+        path = self._ensure_clone(scratch, repo)
+        return path is not None and self._git("-C", path, "fetch", "-q", "origin")
+
+    def op_ls_remote(self, scratch, worker, repo):
+        return self._git("ls-remote", f"{self.url_base}/{repo}")
+
+    def op_push(self, scratch, worker, repo):
+        path = self._ensure_clone(scratch, repo)
+        if path is None:
+            return False
+        stamp = f"{worker} {time.time()}"
+        if not self._git("-C", path, "commit", "-q", "--allow-empty", "--no-verify", "-m", f"loadgen {stamp}"):
+            return False
+        return self._git("-C", path, "push", "-q", "-f", "origin", f"HEAD:refs/heads/loadgen/worker{worker}")
+
+    ###########################################################################
+
+    def run(self, duration=10.0, num_requests=None):
+        """
+        Run the load until `duration` seconds elapsed or `num_requests`
+        requests have been made (whichever comes first)
+
+        :param duration: max duration in seconds (None for no limit)
+        :param num_requests: max number of requests (None for no limit)
+        :return: LoadReport instance
+        """
+        if duration is None and num_requests is None:
+            raise ValueError("either duration or num_requests must be given")
+
+        report = LoadReport()
+        report_lock = threading.Lock()
+        ops = list(self.mix)
+        weights = [self.mix[op] for op in ops]
+        remaining = [num_requests]
+
+        def next_request():
+            with report_lock:
+                if remaining[0] is not None:
+                    if remaining[0] <= 0:
+                        return False
+                    remaining[0] -= 1
+            return deadline is None or time.time() < deadline
+
+        def worker_loop(worker, scratch):
+            rng = random.Random(worker)
+            while next_request():
+                op = rng.choices(ops, weights)[0]
+                repo = rng.choice(self.repos)
+                started = time.perf_counter()
+                ok = getattr(self, self._op_method(op))(scratch, worker, repo)
+                latency = time.perf_counter() - started
+                with report_lock:
+                    report.add(op, latency, ok)
+
+        self.log.info(f"loadgen: {self.workers} workers, mix {self.mix}, repos {self.repos}")
+        server_pid = self.server.process.pid if self.server and self.server.process else None
+        cpu_started = process_cpu_time(server_pid) if server_pid else None
+        requests_started = self.server.metrics()["total"]["requests"] if self.server else {}
+
+        with tempfile.TemporaryDirectory(prefix="repomaker-loadgen-") as tmpdir:
+            time_started = time.time()
+            deadline = time_started + duration if duration is not None else None
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(worker_loop, i, os.path.join(tmpdir, str(i)))
+                           for i in range(self.workers)]
+                for future in futures:
+                    future.result()
+            report.elapsed = time.time() - time_started
+
+        if cpu_started is not None:
+            cpu_ended = process_cpu_time(server_pid)
+            if cpu_ended is not None:
+                report.server_cpu = cpu_ended - cpu_started
+
+        if self.server:
+            requests = self.server.metrics()["total"]["requests"]
+            report.server_requests = {k: v - requests_started.get(k, 0) for k, v in requests.items()}
+
+        return report
+
+
+def parse_mix(s):
+    """
+    Parse operation mix string, e.g. "clone=1,fetch=4" into dict
+    """
+    mix = {}
+    for item in s.split(","):
+        op, _, weight = item.partition("=")
+        mix[op.strip()] = float(weight) if weight else 1.0
+    return mix
+
+
+def parser_create():
+    description = f"""\
+Run concurrent clone, fetch, ls-remote and push clients against a git server
+and report throughput, latency percentiles, error rates and server CPU.
+
+Either start a GitRepoServer serving the repos in --server-root (a sample repo
+is created if there are none) or target an existing server with --url-base.
+"""
+    parser = argparse.ArgumentParser(
+        description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server-root', default="/tmp/reposerver",
+                        help="Start server serving repos in this directory (default %(default)s)")
+    parser.add_argument('--url-base',
+                        help="Use existing server at this URL base instead of starting one")
+    parser.add_argument('--repo', action='append', dest='repos',
+                        help="Repo to use (can be repeated). Default is all repos in --server-root")
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help="Number of concurrent clients (default %(default)s)")
+    parser.add_argument('-d', '--duration', type=float, default=10.0,
+                        help="Duration of run in seconds (default %(default)s)")
+    parser.add_argument('-n', '--num-requests', type=int,
+                        help="Stop after this many requests")
+    parser.add_argument('--mix', type=parse_mix,
+                        help="Operation weights, e.g. clone=1,fetch=4,ls-remote=4,push=1")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Be more verbose")
+
+    return parser
+
+
+def main():
+    parser = parser_create()
+    opt = parser.parse_args()
+    log = Log(level=opt.verbose)
+
+    server = None
+    repos = opt.repos
+    url_base = opt.url_base
+    if not url_base:
+        server = GitRepoServer(opt.server_root, logger=log)
+        server.start()
+        url_base = server.URL_BASE
+        if not repos:
+            repos = [r for r in server.find_repos() if r != "dummy-repo.git"]
+        if not repos:
+            repos = ["loadgen"]
+            r = GitRepo(str(Path(server.root_dir) / "loadgen"), logger=log).init()
+            for i in range(10):
+                r.file_add(f"file{i}", text=f"file {i}\n").commit(message=f"commit {i}")
+    elif not repos:
+        parser.error("--repo is required with --url-base")
+
+    loadgen = LoadGenerator(url_base, repos, mix=opt.mix, workers=opt.workers,
+                            server=server, logger=log)
+    report = loadgen.run(duration=opt.duration, num_requests=opt.num_requests)
+    print(report.summary())
+
+    if server:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
+import functools
 import os
+import shlex
 import shutil
+import subprocess
 import sys
+import threading
+import time
+import weakref
 from pathlib import Path
 
 from .. import run
@@ -12,12 +18,78 @@ class RepoError(Exception):
     """Repo Exception"""
 
 
+class RepoTimeoutError(RepoError):
+    """Repo command exceeded its timeout or the repo deadline"""
+
+
+class RepoCancelledError(RepoError):
+    """Repo command was cancelled with BaseRepo.cancel()"""
+
+
+# Registry of per-repo locks, keyed by the absolute path of the repo, such that
+# all repo instances operating on the same repo share the same lock.
+# (Not the real path, as a repo path can be a symlink that is repointed,
+# see TmpfsStorage)
+_repo_locks = {}
+_repo_locks_guard = threading.Lock()
+
+
+def repo_lock(path):
+    """
+    Return the lock shared by all repo instances of the repo at `path`
+
+    :param path: path of repo
+    :return: threading.RLock instance
+    """
+    key = os.path.abspath(path)
+    with _repo_locks_guard:
+        return _repo_locks.setdefault(key, threading.RLock())
+
+
+# Registry of repo instances, keyed like _repo_locks, such that persistent
+# processes of all instances of a repo can be closed when the repo is moved
+_repo_instances = {}
+
+
+def repo_instances(path):
+    """
+    Return the live repo instances of the repo at `path`
+
+    :param path: path of repo
+    :return: list of repo instances
+    """
+    key = os.path.abspath(path)
+    with _repo_locks_guard:
+        return list(_repo_instances.get(key, ()))
+
+
+def mutating(method):
+    """
+    Decorator for repo methods that change the repo (working tree, index or refs)
+
+    Mutating methods are serialized by the repo lock, whereas query methods
+    run without locking and thus can run in parallel.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class BaseRepo(object):
     """
     """
     VCS = "baserepo"
 
-    def __init__(self, path, parent=None, logger=None, **kwargs):
+    # Max number of times a command is retried when it fails due to lock
+    # contention with another process operating on the same repo
+    LOCK_RETRIES = 6
+
+    # Delay (in seconds) before the first retry. Doubled for every retry
+    LOCK_BACKOFF = 0.05
+
+    def __init__(self, path, parent=None, logger=None, storage=None, timeout=None, **kwargs):
         # path to repo (relative to parent path)
         self.path = path
 
@@ -30,6 +102,23 @@ class BaseRepo(object):
         # parent repo of this repo (if any)
         self.parent = parent
 
+        # lock serializing mutating operations on this repo
+        self.lock = repo_lock(path)
+        with _repo_locks_guard:
+            _repo_instances.setdefault(os.path.abspath(path), weakref.WeakSet()).add(self)
+
+        # storage backend placing the repo on disk (None for plain directory)
+        self.storage = storage
+
+        # max seconds of each command (None for no limit)
+        self.timeout = timeout
+
+        # time.monotonic() by which all commands must be done (see set_deadline())
+        self.deadline = None
+
+        # token for cancelling running commands (see cancel())
+        self._cancel = run.CancelToken()
+
         super().__init__(**kwargs)
 
     def __str__(self):
@@ -48,7 +137,7 @@ class BaseRepo(object):
         return self.path < other.path
 
     @classmethod
-    def create_from_clone(cls, url_base, name, branch=None, args=None):
+    def create_from_clone(cls, url_base, name, branch=None, args=None, timeout=None):
         """
         Clone repo from `url_base/name` and return Repo instance from the clone
 
@@ -56,6 +145,7 @@ class BaseRepo(object):
         :param name: repo name/path
         :param branch: branch or tag to checkout
         :param args: additional git clone args
+        :param timeout: max seconds of the clone and of later commands of the repo
         """
         raise NotImplementedError()
 
@@ -64,49 +154,168 @@ class BaseRepo(object):
     # VCS admin operations
     ###########################################################################
 
-    def _get_cmdline(self, cmdline):
+    def _get_argv(self, args):
         """
-        Return complete commandline string suitable for the repo engine/type
+        Return complete command argv suitable for the repo engine/type
 
-        :param cmdline:
-        :return:
+        :param args: VCS command arguments, e.g. ['commit', '-m', 'message']
+        :return: argv list
         """
         raise NotImplementedError()
 
-    def run_shell_command(self, cmdline, assert_ok=True):
+    def _args_to_argv(self, args):
+        """
+        Return argv of VCS command `args`, which is an argument list or
+        (for compatibility) a string that is split like the shell would do
+
+        :raise RepoError: if an argument is not a string or path
+        """
+        if isinstance(args, str):
+            args = shlex.split(args)
+        argv = []
+        for arg in args:
+            if isinstance(arg, os.PathLike):
+                arg = os.fspath(arg)
+            if not isinstance(arg, str):
+                raise RepoError(f"invalid argument {arg!r} of {self.VCS} command {list(args)}")
+            argv.append(arg)
+        return self._get_argv(argv)
+
+    def _is_lock_error(self, err):
+        """
+        Return True if command error output `err` indicates that the command
+        failed because another process holds a lock on the repo
+
+        :param err: stderr output of failed command
+        :return: True if command can be retried
+        """
+        return False
+
+    def set_deadline(self, seconds):
+        """
+        Set deadline for all commands of this repo instance: commands running
+        at the deadline are killed and later commands fail immediately
+
+        :param seconds: seconds from now (None to clear the deadline)
+        """
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+
+    def cancel(self):
+        """
+        Kill all running commands of this repo instance (e.g. from another
+        thread). They raise RepoCancelledError, later commands run normally.
+        """
+        token, self._cancel = self._cancel, run.CancelToken()
+        token.cancel()
+
+    def _timeout(self, timeout=None):
+        """
+        Return seconds the next command can run: the minimum of `timeout`,
+        the repo timeout and the time left until the repo deadline
+
+        :raise RepoTimeoutError: if the repo deadline has passed
+        """
+        timeouts = [t for t in (timeout, self.timeout) if t is not None]
+        if self.deadline is not None:
+            left = self.deadline - time.monotonic()
+            if left <= 0:
+                raise RepoTimeoutError(f"deadline of {self.path} has passed")
+            timeouts.append(left)
+        return min(timeouts) if timeouts else None
+
+    def _run_with_retry(self, cmd, cwd=None, input=None, timeout=None):
+        """
+        Run `cmd` and retry with exponential backoff as long as it fails
+        due to lock contention (at most LOCK_RETRIES times)
+
+        :param timeout: max seconds of the command, including retries
+        :raise RepoTimeoutError: if the command timed out
+        :raise RepoCancelledError: if the command was cancelled
+        :return: tuple of (exitcode, stdout, stderr)
+        """
+        cancel = self._cancel
+        started = time.monotonic()
+        delay = self.LOCK_BACKOFF
+        for attempt in range(self.LOCK_RETRIES + 1):
+            left = None if timeout is None else timeout - (time.monotonic() - started)
+            try:
+                exitcode, out, err = run.cmd_run(cmd, cwd=cwd, logger=self.log, input=input,
+                                                 timeout=self._timeout(left), cancel=cancel)
+            except subprocess.TimeoutExpired as e:
+                raise RepoTimeoutError(f"'{run.cmd_str(cmd)}' timed out after {e.timeout:.1f}s:\n{e.stderr}")
+            except run.CmdCancelled as e:
+                raise RepoCancelledError(str(e))
+            if exitcode == 0 or attempt == self.LOCK_RETRIES or not self._is_lock_error(err):
+                break
+            self.log.debug(f"lock contention in {self.path}, retrying in {delay:.2f}s")
+            time.sleep(delay)
+            delay *= 2
+
+        return exitcode, out, err
+
+    def run_shell_command(self, cmdline, assert_ok=True, timeout=None):
         """
         Run shell command in repo
 
         :param cmdline: shell command
-        :param assert_ok:
+        :param assert_ok: True to raise RepoError if command fails
+        :param timeout: max seconds of the command (see also set_deadline())
         """
-        exitcode, out, err = run.cmd_run(cmdline, cwd=self.path, logger=self.log)
+        exitcode, out, err = self._run_with_retry(cmdline, cwd=self.path, timeout=timeout)
 
         if assert_ok and exitcode != 0:
-            self.log.error(f"run_shell_command('{cmdline}') failed with exitcode {exitcode}:")
-            self.log.error(err)
-            exit(1)
+            raise RepoError(f"run_shell_command('{cmdline}') failed with exitcode {exitcode}:\n{err or out}")
 
         return out
 
-    def run_command(self, cmdline, assert_ok=True):
+    def run_command(self, args, assert_ok=True, input=None, timeout=None):
         """
-        Run VCS command with cmdline
+        Run VCS command with arguments `args` (without a shell)
 
-        :param cmdline: shell command
-        :param assert_ok:
+        :param args: argument list, or string which is split like the shell would do
+        :param assert_ok: True to raise RepoError if command fails
+        :param input: string to pass on stdin of the command
+        :param timeout: max seconds of the command (see also set_deadline())
         """
-        cmdline = self._get_cmdline(cmdline)
+        argv = self._args_to_argv(args)
 
-        exitcode, out, err = run.cmd_run(cmdline, logger=self.log)
+        exitcode, out, err = self._run_with_retry(argv, input=input, timeout=timeout)
 
         if assert_ok and exitcode != 0:
-            self.log.error(f"run_command('{cmdline}') failed with exitcode {exitcode}:")
-            self.log.error(err)
-            exit(1)
+            raise RepoError(f"run_command('{run.cmd_str(argv)}') failed with exitcode {exitcode}:\n{err or out}")
 
         return out.rstrip()
 
+    def run_command_stream(self, args, sep="\n", input=None, timeout=None):
+        """
+        Run VCS command with arguments `args` and yield its output records
+        as they are produced. Closing the generator early terminates the command.
+
+        :param args: argument list, or string which is split like the shell would do
+        :param sep: output record separator
+        :param input: string to pass on stdin of the command
+        :param timeout: max seconds of the command (see also set_deadline())
+        """
+        argv = self._args_to_argv(args)
+
+        try:
+            yield from run.cmd_stream(argv, logger=self.log, sep=sep, input=input,
+                                      timeout=self._timeout(timeout), cancel=self._cancel)
+        except subprocess.TimeoutExpired as e:
+            raise RepoTimeoutError(f"run_command_stream('{e.cmd}') timed out after {e.timeout:.1f}s:\n{e.stderr}")
+        except run.CmdCancelled as e:
+            raise RepoCancelledError(str(e))
+        except subprocess.CalledProcessError as e:
+            raise RepoError(f"run_command_stream('{e.cmd}') failed with exitcode {e.returncode}:\n{e.stderr}")
+
+    def close_processes(self):
+        """
+        Terminate persistent processes of this repo instance, which have
+        their working directory in the repo (they are restarted on demand),
+        e.g. before the repo is moved
+        """
+        pass
+
     def delete_on_disk(self):
         """
         Delete everything from disk (if it is safe)
@@ -122,7 +331,10 @@ class BaseRepo(object):
                 return False
 
         self.log.verb(f"deleting {self.VCS} repo at {self.path}")
-        shutil.rmtree(self.path)
+        if self.storage and self.storage.is_allocated(self.path):
+            self.storage.release(self.path)
+        else:
+            shutil.rmtree(self.path)
         return True
 
 
@@ -151,7 +363,10 @@ class BaseRepo(object):
         return NotImplementedError()
 
     def is_dirty(self):
-        raise NotImplemented()
+        """
+        Return True if working tree or index has changes
+        """
+        raise NotImplementedError()
 
 
     ###########################################################################
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Persistent 'git cat-file --batch' session for reading objects of a repo
+"""
+import re
+import subprocess
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+
+from .baserepo import RepoError
+from .. import run
+
+
+# Entry of a tree listing (like 'git ls-tree'):
+#   mode: file mode, e.g. '100644'
+#   type: 'blob', 'tree' or 'commit' (submodule)
+#   oid:  object id
+#   path: path relative to repo root
+TreeEntry = namedtuple("TreeEntry", "mode type oid path")
+
+# Object names that always refer to the same object: a full object id,
+# optionally followed by a path, e.g. '<commit oid>:dir/file'
+_IMMUTABLE_NAME_RE = re.compile(r"^([0-9a-f]{40}|[0-9a-f]{64})(:|$)")
+
+
+def _kill(proc):
+    if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+
+
+class CatFile(object):
+    """
+    One long-lived 'git cat-file --batch' process of a repo.
+
+    Requests for several objects are pipelined: they are all written
+    before the responses are read. Object contents are kept in a bounded
+    LRU cache keyed by object id, and names that always refer to the same
+    object (see _IMMUTABLE_NAME_RE) are cached too.
+    """
+
+    def __init__(self, repo, cache_size=64 * 1024 * 1024):
+        """
+        :param repo: GitRepo instance
+        :param cache_size: max total size (in bytes) of cached object contents
+        """
+        self.repo = repo
+        self.cache_size = cache_size
+
+        # object id -> (type, data), least recently used first
+        self._objects = OrderedDict()
+        self._objects_size = 0
+        # immutable object name -> object id
+        self._names = OrderedDict()
+
+        self.lock = threading.Lock()
+        self.process = None
+        self._finalizer = None
+
+    def _start(self):
+        if self.process is None or self.process.poll() is not None:
+            if self.process:
+                # git exited unexpectedly
+                self.process.stdin.close()
+                self.process.stdout.close()
+                self._finalizer.detach()
+            cmd = self.repo._get_argv(["cat-file", "--batch"])
+            self.process = run.cmd_popen(cmd, logger=self.repo.log,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL)
+            self._finalizer = weakref.finalize(self, _kill, self.process)
+        return self.process
+
+    def close(self):
+        """
+        Terminate the cat-file process (it is restarted on next request)
+        """
+        with self.lock:
+            if self.process:
+                self.process.stdin.close()
+                self.process.wait()
+                self.process.stdout.close()
+                self._finalizer.detach()
+                self.process = None
+
+    def _cache_get(self, name):
+        oid = self._names.get(name, name)
+        obj = self._objects.get(oid)
+        if obj is not None:
+            self._objects.move_to_end(oid)
+            if name != oid:
+                self._names.move_to_end(name)
+            return (oid,) + obj
+        return None
+
+    def _cache_put(self, name, oid, type, data):
+        if _IMMUTABLE_NAME_RE.match(name) and name != oid:
+            self._names[name] = oid
+            if len(self._names) > 1024 * 1024:
+                self._names.popitem(last=False)
+
+        if oid in self._objects or len(data) > self.cache_size:
+            return
+        self._objects[oid] = (type, data)
+        self._objects_size += len(data)
+        while self._objects_size > self.cache_size:
+            _, (_, evicted) = self._objects.popitem(last=False)
+            self._objects_size -= len(evicted)
+
+    def get_many(self, names):
+        """
+        Return objects with `names` (anything 'git cat-file' understands,
+        e.g. 'HEAD:dir/file' or an object id)
+
+        :param names: list of object names
+        :return: list with a tuple (oid, type, data) or None (if the object
+                 does not exist) for each name
+        """
+        for name in names:
+            if "\n" in name:
+                raise RepoError(f"invalid object name {name!r}")
+
+        with self.lock:
+            results = [self._cache_get(name) for name in names]
+            todo = [i for i, result in enumerate(results) if result is None]
+            if not todo:
+                return results
+
+            proc = self._start()
+            request = "".join(f"{names[i]}\n" for i in todo).encode("utf8", errors="surrogateescape")
+
+            # write requests from a thread such that git can write responses
+            # while we are still writing requests
+            def write_requests():
+                try:
+                    proc.stdin.write(request)
+                    proc.stdin.flush()
+                except BrokenPipeError:
+                    # git exited, which the reader reports
+                    pass
+
+            writer = threading.Thread(target=write_requests, daemon=True)
+            writer.start()
+
+            for i in todo:
+                header = proc.stdout.readline()
+                if not header:
+                    raise RepoError(f"git cat-file in {self.repo.path} exited unexpectedly")
+                fields = header.decode("utf8", errors="surrogateescape").split()
+                if not fields[-1].isdigit():
+                    # '<name> missing' or '<name> ambiguous' (name may contain spaces)
+                    continue
+                oid, type, size = fields
+                data = proc.stdout.read(int(size) + 1)[:-1]
+                results[i] = (oid, type, data)
+                self._cache_put(names[i], oid, type, data)
+
+            writer.join()
+            return results
+
+    def get(self, name):
+        """
+        Return object with `name` as a tuple (oid, type, data) or None
+        """
+        return self.get_many([name])[0]
+
+    @staticmethod
+    def parse_tree(data, oid_len=20, prefix=""):
+        """
+        Return list of TreeEntry from contents of a tree object
+
+        :param data: tree object contents
+        :param oid_len: length of binary object ids (20 for SHA-1, 32 for SHA-256)
+        :param prefix: path prefix of entries
+        """
+        entries = []
+        pos = 0
+        # tree entries are '<mode> <name>\0<binary oid>'
+        while pos < len(data):
+            space = data.index(b" ", pos)
+            nul = data.index(b"\0", space)
+            mode = data[pos:space].decode()
+            name = data[space + 1:nul].decode("utf8", errors="surrogateescape")
+            oid = data[nul + 1:nul + 1 + oid_len].hex()
+            pos = nul + 1 + oid_len
+            type = "tree" if mode == "40000" else "commit" if mode == "160000" else "blob"
+            entries.append(TreeEntry(mode, type, oid, prefix + name))
+        return entries
+
+    def ls_tree(self, rev, path="", recursive=True):
+        """
+        Return entries of tree `path` at revision `rev`, like 'git ls-tree'.
+        Subtrees are read level by level with pipelined requests.
+
+        :param rev: revision, e.g. 'HEAD'
+        :param path: path of directory (empty for repo root)
+        :param recursive: True to list files of subtrees instead of subtrees
+        :return: list of TreeEntry sorted by path
+        """
+        path = path.strip("/")
+        tree = self.get(f"{rev}:{path}" if path else f"{rev}^{{tree}}")
+        if tree is None or tree[1] != "tree":
+            raise RepoError(f"'{rev}:{path}' is not a tree in {self.repo.path}")
+
+        oid_len = len(tree[0]) // 2
+        prefix = f"{path}/" if path else ""
+        entries = self.parse_tree(tree[2], oid_len, prefix)
+        if not recursive:
+            return entries
+
+        files = []
+        while entries:
+            subtrees = [e for e in entries if e.type == "tree"]
+            files += [e for e in entries if e.type != "tree"]
+            objects = self.get_many([e.oid for e in subtrees])
+            entries = []
+            for subtree, (_, _, data) in zip(subtrees, objects):
+                entries += self.parse_tree(data, oid_len, f"{subtree.path}/")
+
+        return sorted(files, key=lambda e: e.path)
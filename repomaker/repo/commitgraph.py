@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+In-memory commit graph of a repo for fast ancestry queries
+"""
+import heapq
+from array import array
+
+from .baserepo import RepoError
+
+
+class CommitGraph(object):
+    """
+    Commit graph of a GitRepo, loaded from a single 'git rev-list' and
+    queried without running git.
+
+    Commits are numbered in topological order, such that parents always
+    have lower numbers than their children. Parents are stored in compact
+    arrays: the parents of commit i are parent_idx[parent_start[i]:parent_start[i + 1]].
+
+    Revisions passed to the query methods are full commit hashes, ref names
+    (e.g. 'main', 'v1.0', 'refs/heads/main' or 'HEAD' on a branch), which
+    are resolved with a ref map loaded together with the graph, or anything
+    else 'git rev-parse' understands (which costs a git process).
+
+    Every git command run by the owning GitRepo marks the ref map stale,
+    and it is reloaded by the next query that resolves a ref name. Refs and
+    commits changed by other processes are only seen after update().
+    """
+
+    def __init__(self, repo):
+        """
+        :param repo: GitRepo instance
+        """
+        self.repo = repo
+
+        # commit hashes, indexed by commit number
+        self.oids = []
+        # commit hash -> commit number
+        self.index = {}
+        # parents of commits (see class docstring)
+        self.parent_start = array("L", [0])
+        self.parent_idx = array("L")
+        # generation number: 1 for root commits, else 1 + max generation of parents
+        self.generation = array("L")
+        # commit numbers of commits without children
+        self.tips = set()
+        # ref name (full and short) -> object id (peeled for annotated tags)
+        self.refs = {}
+        # True if refs may have changed since the ref map was loaded
+        self._refs_stale = True
+
+        self.update()
+
+    def __len__(self):
+        return len(self.oids)
+
+    def __contains__(self, oid):
+        return oid in self.index
+
+    def _add(self, oid, parents):
+        """
+        Add commit `oid` with parent commit hashes `parents` (all known)
+        """
+        i = len(self.oids)
+        self.oids.append(oid)
+        self.index[oid] = i
+
+        generation = 0
+        for parent in parents:
+            p = self.index[parent]
+            self.parent_idx.append(p)
+            generation = max(generation, self.generation[p])
+            self.tips.discard(p)
+        self.parent_start.append(len(self.parent_idx))
+        self.generation.append(generation + 1)
+        self.tips.add(i)
+
+    def update(self, *revs):
+        """
+        Add commits reachable from `revs` that are not yet in the graph
+
+        The ref map is reloaded too.
+
+        :param revs: rev-list arguments, e.g. "HEAD" (default is "--all")
+        :return: number of commits added
+        """
+        # known tips are excluded on stdin as they can be many
+        exclude = "".join(f"^{self.oids[i]}\n" for i in self.tips)
+        cmd = ["rev-list", "--parents", "--topo-order", "--reverse"] + list(revs or ["--all"]) + ["--stdin"]
+
+        count = 0
+        for line in self.repo.run_command_stream(cmd, input=exclude):
+            oid, *parents = line.split()
+            if oid not in self.index:
+                self._add(oid, parents)
+                count += 1
+
+        self.load_refs()
+        return count
+
+    def load_refs(self):
+        """
+        Load map of ref names to object ids with a single 'git for-each-ref'.
+        Short names are ambiguous, they resolve like git does: tags before
+        branches before remote-tracking branches.
+        """
+        # %(*objectname) is the peeled object of annotated tags (else empty),
+        # %(HEAD) is '*' for the current branch
+        fmt = "%(objectname)%09%(*objectname)%09%(HEAD)%09%(refname)"
+        refs = {}
+        short = {}
+        for line in self.repo.run_command(["for-each-ref", f"--format={fmt}"]).splitlines():
+            oid, peeled, current, refname = line.split("\t", 3)
+            oid = peeled or oid
+            refs[refname] = oid
+            if current == "*":
+                refs["HEAD"] = oid
+            for priority, prefix in enumerate(("refs/tags/", "refs/heads/", "refs/remotes/")):
+                if refname.startswith(prefix):
+                    name = refname[len(prefix):]
+                    if name.endswith("/HEAD") and prefix == "refs/remotes/":
+                        name = name[:-len("/HEAD")]
+                        priority += 1
+                    if name not in short or priority < short[name][0]:
+                        short[name] = (priority, oid)
+        # full ref names take precedence over short names
+        self.refs = {name: oid for name, (_, oid) in short.items()}
+        self.refs.update(refs)
+        self._refs_stale = False
+
+    def refs_changed(self):
+        """
+        Mark the ref map stale, it is reloaded when a ref name is resolved next
+        """
+        self._refs_stale = True
+
+    def parents(self, rev):
+        """
+        Return commit hashes of parents of `rev`
+        """
+        i = self._resolve(rev)
+        return [self.oids[p] for p in self._parents(i)]
+
+    def _parents(self, i):
+        return self.parent_idx[self.parent_start[i]:self.parent_start[i + 1]]
+
+    def _resolve(self, rev):
+        """
+        Return commit number of `rev`
+
+        :raise RepoError: if `rev` is not a commit
+        """
+        i = self.index.get(rev)
+        if i is not None:
+            return i
+
+        if self._refs_stale:
+            self.load_refs()
+        oid = self.refs.get(rev)
+        if oid is not None:
+            if oid not in self.index:
+                # ref was updated outside of the repo instance
+                self.update()
+            i = self.index.get(oid)
+            if i is not None:
+                return i
+
+        oid = self.repo.run_command(["rev-parse", "--verify", "--quiet", f"{rev}^{{commit}}"], assert_ok=False)
+        if oid and oid not in self.index:
+            # commit was made outside of the repo instance
+            self.update()
+        i = self.index.get(oid)
+        if i is None:
+            raise RepoError(f"'{rev}' is not a commit in {self.repo.path}")
+        return i
+
+    ###########################################################################
+    # Queries
+    ###########################################################################
+
+    def is_ancestor(self, ancestor, rev):
+        """
+        Return True if commit `ancestor` is reachable from `rev` (or is `rev`)
+        """
+        a = self._resolve(ancestor)
+        i = self._resolve(rev)
+        return self._is_ancestor(a, i)
+
+    def _is_ancestor(self, a, i):
+        if a == i:
+            return True
+        # an ancestor has a lower number and a lower generation
+        min_generation = self.generation[a]
+        if a > i or min_generation >= self.generation[i]:
+            return False
+
+        seen = {i}
+        stack = [i]
+        while stack:
+            for p in self._parents(stack.pop()):
+                if p == a:
+                    return True
+                if p not in seen and p > a and self.generation[p] > min_generation:
+                    seen.add(p)
+                    stack.append(p)
+        return False
+
+    def merge_bases(self, rev1, rev2):
+        """
+        Return all best common ancestors of `rev1` and `rev2`, like
+        'git merge-base --all'
+
+        :return: list of commit hashes (empty if there is no common ancestor)
+        """
+        i1 = self._resolve(rev1)
+        i2 = self._resolve(rev2)
+        if i1 == i2:
+            return [self.oids[i1]]
+
+        # Paint ancestors of rev1 and rev2, visiting commits in decreasing
+        # commit number such that all children of a commit are visited
+        # before the commit itself. A commit painted by both is a common
+        # ancestor, and its ancestors are stale (not best) common ancestors.
+        paint1, paint2, stale = 1, 2, 4
+        flags = {i1: paint1, i2: paint2}
+        heap = [-i1, -i2]
+        heapq.heapify(heap)
+        results = []
+        while any(not flags[-i] & stale for i in heap):
+            i = -heapq.heappop(heap)
+            f = flags[i]
+            if f & (paint1 | paint2) == paint1 | paint2 and not f & stale:
+                results.append(i)
+                f |= stale
+            for p in self._parents(i):
+                if p not in flags:
+                    flags[p] = 0
+                    heapq.heappush(heap, -p)
+                flags[p] |= f
+
+        # remove results that are ancestors of other results
+        best = [i for i in results
+                if not any(j != i and self._is_ancestor(i, j) for j in results)]
+        return [self.oids[i] for i in best]
+
+    def merge_base(self, rev1, rev2):
+        """
+        Return best common ancestor of `rev1` and `rev2` like 'git merge-base'
+
+        :return: commit hash or None if there is no common ancestor
+        """
+        bases = self.merge_bases(rev1, rev2)
+        return bases[0] if bases else None
+
+    def _reachable(self, revs, exclude=()):
+        """
+        Return bytearray with 1 for commits reachable from `revs`
+        but not from `exclude`
+        """
+        # resolve first, as resolving can add commits to the graph
+        starts = [(2, [self._resolve(rev) for rev in exclude]),
+                  (1, [self._resolve(rev) for rev in revs])]
+        marks = bytearray(len(self.oids))
+        for value, stack in starts:
+            while stack:
+                i = stack.pop()
+                if marks[i]:
+                    continue
+                marks[i] = value
+                stack.extend(p for p in self._parents(i) if not marks[p])
+
+        # unmark excluded commits
+        return marks.replace(b"\x02", b"\x00")
+
+    def reachable(self, revs, exclude=()):
+        """
+        Return set of commits reachable from any of `revs` but not from
+        any of `exclude`, like 'git rev-list revs --not exclude'
+
+        :param revs: list of revisions
+        :param exclude: list of revisions
+        :return: set of commit hashes
+        """
+        marks = self._reachable(revs, exclude)
+        return {self.oids[i] for i, mark in enumerate(marks) if mark}
+
+    def topo_order(self, revs=None, exclude=()):
+        """
+        Return commits in topological order (children before parents), like
+        'git rev-list --topo-order'
+
+        :param revs: list of revisions (None for all commits)
+        :param exclude: list of revisions to exclude, including their ancestors
+        :return: list of commit hashes
+        """
+        if revs is None and not exclude:
+            return self.oids[::-1]
+
+        if revs is None:
+            revs = [self.oids[i] for i in self.tips]
+        marks = self._reachable(revs, exclude)
+        return [self.oids[i] for i in range(len(marks) - 1, -1, -1) if marks[i]]
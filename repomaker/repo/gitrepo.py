@@ -1,12 +1,35 @@
 #!/usr/bin/env python3
 import os
+import re
+import shlex
 import shutil
+from collections import namedtuple
 from pathlib import Path
 
-from .baserepo import BaseRepo, RepoError
+from .baserepo import BaseRepo, RepoError, mutating
+from .catfile import CatFile
+from .commitgraph import CommitGraph
 from .. import run
 
 
+# stderr messages of git commands that failed because another git process
+# holds the index lock or a ref lock, e.g.:
+#   fatal: Unable to create '/path/.git/index.lock': File exists.
+#   error: cannot lock ref 'refs/heads/main': Unable to create '...main.lock': File exists.
+_LOCK_ERROR_RE = re.compile(r"Unable to create '[^']*\.lock'|cannot lock ref|could not lock config file")
+
+
+# Entry of 'git status' output:
+#   kind:      '1' changed, '2' renamed/copied, 'u' unmerged, '?' untracked, '!' ignored
+#   xy:        two-letter index/worktree status, e.g. '.M' (None for untracked/ignored)
+#   path:      path of file
+#   orig_path: path of file before rename/copy (None unless kind is '2')
+StatusEntry = namedtuple("StatusEntry", "kind xy path orig_path")
+
+# number of space separated fields before the path in porcelain v2 entries
+_STATUS_FIELDS = {"1": 8, "2": 9, "u": 10, "?": 1, "!": 1}
+
+
 class GitRepo(BaseRepo):
     """
     Git repo class.
@@ -16,15 +39,41 @@ class GitRepo(BaseRepo):
     USER_NAME = "Ada Lovelace"
     USER_EMAIL = "ada@unito.it"
 
+    # CommitGraph instance (loaded on first call of commit_graph())
+    _commit_graph = None
+
+    # CatFile instance (started on first call of cat_file())
+    _cat_file = None
+
     @classmethod
-    def create_from_clone(cls, url_base, name, branch=None, args=None, logger=None):
+    def create_from_clone(cls, url_base, name, branch=None, args=None, logger=None, storage=None,
+                          timeout=None):
         # [--recurse-submodules[=<pathspec>]] [--[no-]shallow-submodules]
         # --branch <name>
-        args = f"{args} " if args else ""
-        branch = f"--branch {branch} " if branch else ""
-        cmd = f"git clone {branch}{args}{url_base}/{name}"
-        repo = cls(name, logger=logger)
-        run.cmd_run(cmd, logger=logger, assert_ok=True)
+        if isinstance(args, str):
+            args = shlex.split(args)
+        cmd = ["git", "clone"]
+        if branch:
+            cmd += ["--branch", branch]
+        cmd += list(args or []) + [f"{url_base}/{name}"]
+        repo = cls(name, logger=logger, storage=storage, timeout=timeout)
+        existed = os.path.lexists(name)
+        if storage:
+            storage.allocate(name)
+        try:
+            exitcode, out, err = repo._run_with_retry(cmd)
+            if exitcode != 0:
+                raise RepoError(f"'{run.cmd_str(cmd)}' failed with exitcode {exitcode}:\n{err or out}")
+        except RepoError:
+            # remove the tmpfs allocation and anything a failed or killed
+            # clone left behind (but not a directory that existed before)
+            if storage:
+                storage.release(name)
+            if not existed:
+                shutil.rmtree(name, ignore_errors=True)
+            raise
+        if storage:
+            storage.configure(repo)
         return repo
 
 
@@ -32,8 +81,11 @@ class GitRepo(BaseRepo):
     # VCS admin operations
     ###########################################################################
 
-    def _get_cmdline(self, cmdline):
-        return f"git -C {self.path} {cmdline}"
+    def _get_argv(self, args):
+        return ["git", "-C", str(self.path)] + list(args)
+
+    def _is_lock_error(self, err):
+        return bool(_LOCK_ERROR_RE.search(err))
 
     def config_read(self, key):
         """
@@ -42,9 +94,10 @@ class GitRepo(BaseRepo):
         :param key: Config key to read, e.g. 'user.email'
         :return: Value of config key
         """
-        out = self.run_command(f"config {key}", assert_ok=False)
+        out = self.run_command(["config", key], assert_ok=False)
         return out.strip()
 
+    @mutating
     def config_write(self, key, value):
         """
         Write local repo git config with key `key` with `value`
@@ -52,8 +105,9 @@ class GitRepo(BaseRepo):
         :param key: Config key to write, e.g. 'user.email'
         :param value: Value of config key
         """
-        self.run_command(f"config {key} '{value}'")
+        self.run_command(["config", key, value])
 
+    @mutating
     def config_write_user(self, user_name=None, user_email=None, force=False):
         """
         If git repo config does not contain 'user.name' then write
@@ -77,13 +131,271 @@ class GitRepo(BaseRepo):
                 user_email = GitRepo.USER_EMAIL
             self.config_write("user.email", user_email)
 
+    @mutating
+    def pack_maintenance(self, bitmaps=True, commit_graph=True, multi_pack_index=True):
+        """
+        Repack all objects of the repo into a single pack and write the
+        auxiliary indexes that make clone and fetch from this repo fast.
+
+        A repo built by a sequence of commits consists of loose objects only,
+        which the server must enumerate and compress again for every clone.
+
+        :param bitmaps: True to write a reachability bitmap index
+        :param commit_graph: True to write the commit-graph file
+        :param multi_pack_index: True to write the multi-pack-index
+        :return: self
+        """
+        arg_bitmaps = ["--write-bitmap-index"] if bitmaps else []
+        self.run_command(["repack", "-a", "-d", "-q"] + arg_bitmaps)
+
+        if commit_graph:
+            self.run_command(["commit-graph", "write", "--reachable"])
+
+        # an empty repo has no packs to index
+        if multi_pack_index and self.count_objects().get("packs", 0):
+            self.run_command(["multi-pack-index", "write"])
+
+        return self
+
+    @mutating
+    def status_optimize(self, untracked_cache=True, split_index=True, fsmonitor=True):
+        """
+        Configure the repo for fast status of huge working trees that are
+        queried repeatedly.
+
+        The built-in file system monitor daemon is only enabled if it is
+        supported on this platform.
+
+        :param untracked_cache: True to cache untracked directory listings
+        :param split_index: True to split the index in a shared base and a
+                            small index of changes, which is faster to write
+        :param fsmonitor: True to start file system monitor daemon, such that
+                          status only examines files changed since last status
+        :return: self
+        """
+        if untracked_cache:
+            self.config_write("core.untrackedCache", "true")
+            self.run_command(["update-index", "--untracked-cache"])
+
+        if split_index:
+            self.config_write("core.splitIndex", "true")
+            self.run_command(["update-index", "--split-index"])
+
+        if fsmonitor:
+            exitcode, _, err = run.cmd_run(self._get_argv(["fsmonitor--daemon", "start"]), logger=self.log)
+            if exitcode == 0 or "already running" in err:
+                self.config_write("core.fsmonitor", "true")
+            else:
+                self.log.verb(f"fsmonitor not enabled for {self.path}: {err.strip()}")
+
+        return self
+
 
     ###########################################################################
     # VCS query operations
     ###########################################################################
 
     def get_current_branch(self):
-        return self.run_command(f"branch --show-current")
+        return self.run_command(["branch", "--show-current"])
+
+    def iter_status(self, untracked=True, ignored=False, renames=True):
+        """
+        Yield StatusEntry for every change in the index and working tree
+        while parsing output of 'git status --porcelain=v2 -z' as it
+        is produced. Closing the generator early terminates git status.
+
+        :param untracked: True to include untracked files
+        :param ignored: True to include ignored files
+        :param renames: True to detect renames
+        """
+        args = ["status", "--porcelain=v2", "-z", "-unormal" if untracked else "-uno"]
+        if ignored:
+            args.append("--ignored")
+        if not renames:
+            args.append("--no-renames")
+
+        records = self.run_command_stream(args, sep="\0")
+        try:
+            for record in records:
+                kind = record[:1]
+                nfields = _STATUS_FIELDS.get(kind)
+                if nfields is None:
+                    # header line, e.g. '# branch.oid'
+                    continue
+                fields = record.split(" ", nfields)
+                xy = fields[1] if nfields > 1 else None
+                # rename/copy entry is followed by the original path
+                orig_path = next(records) if kind == "2" else None
+                yield StatusEntry(kind, xy, fields[nfields], orig_path)
+        finally:
+            records.close()
+
+    def status(self, untracked=True, ignored=False):
+        """
+        Return all changes in the index and working tree
+
+        :param untracked: True to include untracked files
+        :param ignored: True to include ignored files
+        :return: list of StatusEntry
+        """
+        return list(self.iter_status(untracked=untracked, ignored=ignored))
+
+    def is_dirty(self, untracked=True):
+        """
+        Return True if the index or working tree has changes.
+        Stops at the first change found.
+
+        :param untracked: True to consider untracked files as changes
+        """
+        for _ in self.iter_status(untracked=untracked, renames=False):
+            return True
+        return False
+
+    def commit_graph(self):
+        """
+        Return in-memory commit graph of the repo for fast ancestry,
+        merge-base, reachability and topological order queries.
+
+        The graph is loaded on first call and updated with the commits made
+        by this instance. Changes made by other processes need an update()
+        of the graph (see CommitGraph).
+
+        :return: CommitGraph instance
+        """
+        if self._commit_graph is None:
+            # the repo lock keeps concurrent first calls from loading two graphs
+            with self.lock:
+                if self._commit_graph is None:
+                    self._commit_graph = CommitGraph(self)
+        return self._commit_graph
+
+    def _run_with_retry(self, cmd, cwd=None, input=None, timeout=None):
+        # any command may create, move or delete refs
+        if self._commit_graph is not None:
+            self._commit_graph.refs_changed()
+        return super()._run_with_retry(cmd, cwd=cwd, input=input, timeout=timeout)
+
+    def run_command_stream(self, args, sep="\n", input=None, timeout=None):
+        if self._commit_graph is not None:
+            self._commit_graph.refs_changed()
+        return super().run_command_stream(args, sep=sep, input=input, timeout=timeout)
+
+    def cat_file(self):
+        """
+        Return the persistent 'git cat-file --batch' session of the repo,
+        which is started on first call.
+
+        :return: CatFile instance
+        """
+        if self._cat_file is None:
+            with self.lock:
+                if self._cat_file is None:
+                    self._cat_file = CatFile(self)
+        return self._cat_file
+
+    def close_processes(self):
+        """
+        Terminate the cat-file session and the file system monitor daemon
+        (see status_optimize()) of the repo, which are restarted on demand
+        """
+        if self._cat_file is not None:
+            self._cat_file.close()
+        if self.config_read("core.fsmonitor") == "true":
+            self.run_command(["fsmonitor--daemon", "stop"], assert_ok=False)
+
+    def read(self, rev, path):
+        """
+        Return contents of file `path` at revision `rev`
+
+        :param rev: revision, e.g. 'HEAD', a branch name or commit hash
+        :param path: file path in repo
+        :return: file contents as bytes
+        """
+        obj = self.cat_file().get(f"{rev}:{path}")
+        if obj is None:
+            raise RepoError(f"'{path}' does not exist at '{rev}' in {self.path}")
+        return obj[2]
+
+    def read_many(self, rev, paths):
+        """
+        Return contents of files `paths` at revision `rev`, read with
+        pipelined requests to the cat-file session
+
+        :param rev: revision, e.g. 'HEAD', a branch name or commit hash
+        :param paths: file paths in repo
+        :return: dict of path -> file contents as bytes (None if file does not exist)
+        """
+        paths = list(paths)
+        objects = self.cat_file().get_many([f"{rev}:{path}" for path in paths])
+        return {path: obj[2] if obj else None for path, obj in zip(paths, objects)}
+
+    def ls_tree(self, rev, path="", recursive=True):
+        """
+        Return entries of directory `path` at revision `rev`
+
+        :param rev: revision, e.g. 'HEAD', a branch name or commit hash
+        :param path: directory path in repo (empty for repo root)
+        :param recursive: True to list all files below `path`
+        :return: list of TreeEntry sorted by path
+        """
+        return self.cat_file().ls_tree(rev, path, recursive=recursive)
+
+    def state_diff(self, expected, rev="HEAD"):
+        """
+        Return differences between the repo and `expected` state, read with
+        one 'for-each-ref' and one 'ls-tree -r'
+
+        :param expected: RepoState instance
+        :param rev: revision of which files are compared
+        :return: list of StateDiff (empty if the repo is in the expected state)
+        """
+        return expected.diff(self, rev)
+
+    def assert_state(self, expected, rev="HEAD"):
+        """
+        Raise AssertionError describing the differences if the repo is not
+        in `expected` state
+
+        :param expected: RepoState instance
+        :param rev: revision of which files are compared
+        :return: self
+        """
+        expected.assert_matches(self, rev)
+        return self
+
+    def worktree_list(self):
+        """
+        Return list of worktrees of the repo (including the main worktree)
+
+        :return: list of dicts with keys 'worktree' (path), 'HEAD' (commit hash)
+                 and either 'branch' (full ref name) or 'detached'
+        """
+        worktrees = []
+        for line in self.run_command(["worktree", "list", "--porcelain"]).splitlines():
+            key, _, value = line.partition(" ")
+            if key == "worktree":
+                worktrees.append({})
+            if worktrees and key:
+                worktrees[-1][key] = value
+        return worktrees
+
+    def worktree_branches(self):
+        """
+        Return short names of branches checked out in any worktree
+        """
+        return [wt["branch"][len("refs/heads/"):]
+                for wt in self.worktree_list() if "branch" in wt]
+
+    def count_objects(self):
+        """
+        Return object statistics of the repo from 'git count-objects -v'
+
+        :return: dict with integer values, e.g. {'count': 0, 'packs': 1, ...}
+        """
+        out = self.run_command(["count-objects", "-v"])
+
+        stats = [line.split(": ", 1) for line in out.splitlines()]
+        return {key.replace("-", "_"): int(value) for key, value in stats}
 
     def reflog(self, ref=""):
         """
@@ -98,7 +410,9 @@ class GitRepo(BaseRepo):
         # %D  = ref names without the " (", ")" wrapping.
         # %gd = shortened reflog selector, e.g., stash@{1}
         # %gs = reflog subject
-        cmd = f"reflog --format='%h%x09%D%x09%gs' {ref}"
+        cmd = ["reflog", "--format=%h%x09%D%x09%gs"]
+        if ref:
+            cmd.append(ref)
         out = self.run_command(cmd)
 
         reflog = [line.split("\t") for line in out.splitlines()]
@@ -124,15 +438,59 @@ class GitRepo(BaseRepo):
     # VCS state operation
     ###########################################################################
 
+    @mutating
     def checkout(self, ref=None):
-        self.run_command(f"checkout {ref}")
+        # None stays on the tip of the current branch
+        self.run_command(["checkout"] + ([ref] if ref is not None else []))
         return self
 
 
+    @mutating
+    def worktree_add(self, ref, path, branch=None):
+        """
+        Check out `ref` in a new working tree at `path` that shares the
+        object store and refs of this repo, which is much cheaper than a clone.
+
+        Each worktree has its own index and HEAD, and thus its own lock,
+        such that worktrees can be driven concurrently.
+
+        :param ref: revision to check out. A branch can only be checked out
+                    in one worktree, so other worktrees get a detached HEAD
+                    unless `branch` is given
+        :param path: path of new worktree
+        :param branch: name of new branch to create at `ref` and check out
+        :return: GitRepo instance of the worktree (with this repo as parent)
+        """
+        path = os.path.abspath(path)
+        args = ["worktree", "add", "-q"]
+        if branch:
+            args += ["-b", branch]
+        elif ref in self.worktree_branches():
+            args.append("--detach")
+        self.run_command(args + [path, ref])
+
+        return GitRepo(path, parent=self, logger=self.log, timeout=self.timeout)
+
+    @mutating
+    def worktree_remove(self, worktree, force=False):
+        """
+        Remove worktree created with worktree_add()
+
+        :param worktree: GitRepo instance or path of worktree
+        :param force: True to remove worktree even if it has changes
+        """
+        path = worktree.path if isinstance(worktree, BaseRepo) else worktree
+        args = ["worktree", "remove"]
+        if force:
+            args.append("--force")
+        self.run_command(args + [os.path.abspath(path)])
+        return self
+
     ###########################################################################
     # VCS change operations
     ###########################################################################
 
+    @mutating
     def init(self):
         """
         Initialize git repo and set user.name and user.email to default values.
@@ -144,16 +502,22 @@ class GitRepo(BaseRepo):
         # or
         #     git init -b main
         path = Path(self.path)
+        if self.storage and not self.storage.is_allocated(path):
+            self.storage.allocate(path)
         if not path.is_dir():
             path.mkdir()
 
-        self.run_command("init")
+        self.run_command(["init"])
 
         # ensure there is a username and email
         self.config_write_user()
 
+        if self.storage:
+            self.storage.configure(self)
+
         return self
 
+    @mutating
     def file_add(self, filepath, srcfile=None, text=None, force=False):
         """
         Add file with relative path `filepath` to the index.
@@ -190,35 +554,45 @@ class GitRepo(BaseRepo):
         else:
             text = f"some text in {filepath}"
 
-        self.run_command(f"add {filepath}")
+        self.run_command(["add", "--", str(filepath)])
         return self
 
+    @mutating
     def file_remove(self, filepath):
-        self.run_command(f"rm {filepath}")
+        self.run_command(["rm", "-q", "--", str(filepath)])
         return self
 
-    def commit(self, message=None, addremove=False, verify=False):
+    @mutating
+    def commit(self, message, addremove=False, verify=False):
         if addremove:
-            self.run_command("add -A")
+            self.run_command(["add", "-A"])
 
         # optionally bypass pre-commit and commit-msg hooks
-        arg_verify = "" if verify else "--no-verify "
+        arg_verify = [] if verify else ["--no-verify"]
+
+        self.run_command(["commit"] + arg_verify + ["-m", message])
+
+        if self._commit_graph is not None:
+            self._commit_graph.update("HEAD")
 
-        self.run_command(f"commit {arg_verify}-m '{message}'")
+        if self.storage:
+            self.storage.enforce_budget()
         return self
 
+    @mutating
     def tag(self, name, message=None, ref=None):
         if not ref:
             ref = "HEAD"
         message = message if message else name
-        cmd = f"tag -a {name} -m '{message}' {ref}"
-        self.run_command(cmd)
+        self.run_command(["tag", "-a", name, "-m", message, ref])
         return self
 
+    @mutating
     def branch_create(self, name):
-        self.run_command(f"checkout -b {name}")
+        self.run_command(["checkout", "-b", name])
         return self
 
+    @mutating
     def branch_move(self, name):
-        self.run_command(f"branch -M {name}")
+        self.run_command(["branch", "-M", name])
         return self
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Description of the expected state of a repo and comparison with its actual state
+"""
+import difflib
+import hashlib
+import re
+from collections import namedtuple
+
+from .catfile import TreeEntry
+
+
+class _Any(object):
+    def __repr__(self):
+        return "ANY"
+
+
+# Expected value of an item that must exist, whatever its contents or target
+ANY = _Any()
+
+# Difference between expected and actual repo state:
+#   kind:     'file', 'branch', 'tag' or 'head'
+#   name:     file path, branch or tag name ('HEAD' for kind 'head')
+#   expected: blob hash, commit hash, branch name or ANY (None if the item should not exist)
+#   actual:   blob hash, commit hash or branch name (None if the item does not exist)
+StateDiff = namedtuple("StateDiff", "kind name expected actual")
+
+_OID_RE = re.compile(r"^([0-9a-f]{40}|[0-9a-f]{64})$")
+
+
+def blob_hash(data, algorithm="sha1"):
+    """
+    Return object id of a blob with contents `data`, like 'git hash-object'
+
+    :param data: file contents as bytes or str (encoded as UTF-8)
+    :param algorithm: object format of the repo, 'sha1' or 'sha256'
+    """
+    if isinstance(data, str):
+        data = data.encode("utf8")
+    h = hashlib.new(algorithm, b"blob %d\0" % len(data))
+    h.update(data)
+    return h.hexdigest()
+
+
+class RepoState(object):
+    """
+    Expected state of a repo: files (and their contents) at a revision,
+    branches, tags and the current branch.
+
+    Expected values are the contents of a file or the revision a branch or
+    tag points to, ANY for an item that must exist and None for an item
+    that must not exist. Only the given parts are checked, e.g.
+    RepoState(files={...}) does not check branches. If `exact` is True,
+    files, branches and tags that are not listed are reported as unexpected.
+
+    The actual state is read with two git commands ('for-each-ref' and
+    'ls-tree -r') and compared with blob hashes of the expected contents,
+    so the cost does not depend on the number of expected items.
+
+    Example:
+
+        expected = RepoState(files={"a": "text\\n", "dir/b": None},
+                             branches={"master": ANY, "feature": "master~1"},
+                             tags=["v1.0"], head="master")
+        repo.assert_state(expected)
+    """
+
+    # see module level ANY
+    ANY = ANY
+
+    def __init__(self, files=None, branches=None, tags=None, head=None, exact=True):
+        """
+        :param files:    dict of path -> contents (str or bytes), ANY or None
+        :param branches: dict of branch name -> revision, ANY or None, or list
+                         of names of branches that must exist
+        :param tags:     dict of tag name -> commit the tag points to, ANY or
+                         None, or list of names of tags that must exist
+        :param head:     name of current branch
+        :param exact:    True to report files, branches and tags not listed
+        """
+        self.files = self._as_dict(files)
+        self.branches = self._as_dict(branches)
+        self.tags = self._as_dict(tags)
+        self.head = head
+        self.exact = exact
+
+    def __str__(self):
+        parts = [f"{name}={len(value)}" for name, value in
+                 (("files", self.files), ("branches", self.branches), ("tags", self.tags)) if value is not None]
+        if self.head:
+            parts.append(f"head={self.head}")
+        return f"<{self.__class__.__name__} {' '.join(parts)}>"
+
+    @staticmethod
+    def _as_dict(items):
+        if items is None or isinstance(items, dict):
+            return items
+        return {name: ANY for name in items}
+
+    ###########################################################################
+    # Actual state
+    ###########################################################################
+
+    @staticmethod
+    def _read_refs(repo):
+        """
+        Return tuple of (branches, tags, head) of `repo`, where branches and
+        tags are dicts of name -> commit hash (tags are peeled) and head is
+        the current branch (None if detached)
+        """
+        branches, tags, head = {}, {}, None
+        # %(HEAD) is '*' for the current branch, %(*objectname) is the peeled
+        # object of annotated tags (else empty)
+        fmt = "%(HEAD)%09%(objectname)%09%(*objectname)%09%(refname)"
+        for line in repo.run_command(["for-each-ref", f"--format={fmt}", "refs/heads", "refs/tags"]).splitlines():
+            current, oid, peeled, refname = line.split("\t", 3)
+            if refname.startswith("refs/heads/"):
+                name = refname[len("refs/heads/"):]
+                branches[name] = oid
+                if current == "*":
+                    head = name
+            else:
+                tags[refname[len("refs/tags/"):]] = peeled or oid
+        return branches, tags, head
+
+    @staticmethod
+    def _read_tree(repo, rev):
+        """
+        Return dict of path -> TreeEntry of all files at revision `rev`
+        (empty if `rev` does not exist, e.g. in a repo without commits)
+        """
+        if not repo.run_command(["rev-parse", "--verify", "--quiet", f"{rev}^{{tree}}"], assert_ok=False):
+            return {}
+        files = {}
+        for record in repo.run_command_stream(["ls-tree", "-r", "-z", "--full-tree", rev], sep="\0"):
+            info, path = record.split("\t", 1)
+            mode, type, oid = info.split()
+            files[path] = TreeEntry(mode, type, oid, path)
+        return files
+
+    @staticmethod
+    def _resolve(repo, revs):
+        """
+        Return dict of rev -> commit hash (None if unknown) for revisions
+        `revs`. Full commit hashes are used as is, others are resolved with
+        pipelined requests to the cat-file session of the repo.
+        """
+        resolved = {rev: rev for rev in revs if _OID_RE.match(rev)}
+        todo = [rev for rev in revs if rev not in resolved]
+        if todo:
+            objects = repo.cat_file().get_many([f"{rev}^{{commit}}" for rev in todo])
+            resolved.update((rev, obj[0] if obj else None) for rev, obj in zip(todo, objects))
+        return resolved
+
+    ###########################################################################
+    # Comparison
+    ###########################################################################
+
+    def _diff_items(self, kind, expected, actual):
+        """
+        Return list of StateDiff between dicts of name -> object id `expected`
+        (values can be ANY or None, see class docstring) and `actual`
+        """
+        diffs = []
+        for name, value in expected.items():
+            found = actual.get(name)
+            if value is ANY:
+                if found is None:
+                    diffs.append(StateDiff(kind, name, ANY, None))
+            elif value != found:
+                diffs.append(StateDiff(kind, name, value, found))
+        if self.exact:
+            diffs += [StateDiff(kind, name, None, value)
+                      for name, value in sorted(actual.items()) if name not in expected]
+        return diffs
+
+    def diff(self, repo, rev="HEAD"):
+        """
+        Return differences between this expected state and the actual state of `repo`
+
+        :param repo: GitRepo instance
+        :param rev: revision of which files are compared
+        :return: list of StateDiff (empty if the repo is in the expected state)
+        """
+        diffs = []
+
+        if self.branches is not None or self.tags is not None or self.head is not None:
+            branches, tags, head = self._read_refs(repo)
+
+            if self.head is not None and head != self.head:
+                diffs.append(StateDiff("head", "HEAD", self.head, head))
+
+            for kind, spec, actual in (("branch", self.branches, branches), ("tag", self.tags, tags)):
+                if spec is None:
+                    continue
+                resolved = self._resolve(repo, [v for v in spec.values() if v is not None and v is not ANY])
+                expected = {}
+                for name, value in spec.items():
+                    if value is not None and value is not ANY:
+                        # an unknown revision never matches
+                        value = resolved[value] or f"<unknown revision {value}>"
+                    expected[name] = value
+                diffs += self._diff_items(kind, expected, actual)
+
+        if self.files is not None:
+            tree = self._read_tree(repo, rev)
+            algorithm = "sha256" if any(len(entry.oid) == 64 for entry in tree.values()) else "sha1"
+            expected = {path: blob_hash(data, algorithm) if data is not None and data is not ANY else data
+                        for path, data in self.files.items()}
+            diffs += self._diff_items("file", expected, {path: entry.oid for path, entry in tree.items()})
+
+        return diffs
+
+    def format_diff(self, repo, diffs):
+        """
+        Return human readable description of `diffs`, including a unified
+        diff of the contents of text files with unexpected contents
+
+        :param repo: GitRepo instance
+        :param diffs: list of StateDiff as returned by diff()
+        """
+        changed = [d for d in diffs if d.kind == "file" and d.expected not in (None, ANY) and d.actual]
+        contents = repo.cat_file().get_many([d.actual for d in changed])
+        actual_contents = {d.name: obj[2] if obj else b"" for d, obj in zip(changed, contents)}
+
+        lines = []
+        for d in diffs:
+            if d.kind == "head":
+                lines.append(f"HEAD: expected branch {d.expected}, found {d.actual or 'detached HEAD'}")
+            elif d.actual is None:
+                lines.append(f"{d.kind} {d.name}: missing")
+            elif d.expected is None:
+                lines.append(f"{d.kind} {d.name}: unexpected")
+            elif d.kind != "file":
+                lines.append(f"{d.kind} {d.name}: expected {d.expected}, found {d.actual}")
+            else:
+                lines.append(f"file {d.name}: contents differ (expected blob {d.expected}, found {d.actual})")
+                expected = self.files[d.name]
+                if isinstance(expected, str):
+                    expected = expected.encode("utf8")
+                try:
+                    a = expected.decode("utf8").splitlines(keepends=True)
+                    b = actual_contents[d.name].decode("utf8").splitlines(keepends=True)
+                except UnicodeDecodeError:
+                    continue
+                udiff = difflib.unified_diff(a, b, f"expected/{d.name}", f"actual/{d.name}")
+                lines += ["    " + line.rstrip("\n") for line in udiff]
+        return "\n".join(lines)
+
+    def assert_matches(self, repo, rev="HEAD"):
+        """
+        Raise AssertionError describing the differences if `repo` is not in
+        this expected state
+
+        :param repo: GitRepo instance
+        :param rev: revision of which files are compared
+        """
+        diffs = self.diff(repo, rev)
+        if diffs:
+            raise AssertionError(f"{repo.path} is not in expected state:\n{self.format_diff(repo, diffs)}")
@@ -5,17 +5,32 @@ import atexit
 import os
 import shlex
 import shutil
+import signal
+import socket
+import threading
 import time
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from . import run
+from .daemonlog import GitDaemonLog
+from .repo.gitrepo import GitRepo
 
 
 class RepoServerError(Exception):
     """RepoServer exception"""
 
 
+def free_port():
+    """
+    Return a TCP port on localhost that is currently free
+    """
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
 class RepoServer(object):
     """
     This class can start a repo server (e.g. git daemon) that users
@@ -28,15 +43,21 @@ class RepoServer(object):
     # The base URL of this repo server class (overridden in subclass)
     URL_BASE = None
 
-    def __init__(self, work_dir, logger=None, logfile=None):
+    # Seconds stop() waits for the server to terminate before killing it
+    STOP_TIMEOUT = 5
+
+    def __init__(self, work_dir, logger=None, logfile=None, storage=None):
         """
         Create new server object
 
         :param work_dir:  Directory to start process from
         :param logger:    Log instance to use for logging from this class
         :param logfile:   Path of server's logfile
+        :param storage:   Storage backend for repos on the server, e.g. TmpfsStorage
+                          (pass it to the repos created on the server)
         """
         self.work_dir = work_dir
+        self.storage = storage
 
         if not logfile:
             logfile = Path(work_dir) / f"{self.VCS}-server.log"
@@ -64,6 +85,8 @@ class RepoServer(object):
         Delete all repos on server
         """
         self.log.info(f"{self} deleting all repos")
+        if self.storage:
+            self.storage.release_under(self.root_dir)
         shutil.rmtree(self.root_dir, ignore_errors=True)
 
     def atinit(self):
@@ -86,7 +109,10 @@ class RepoServer(object):
 
         args = shlex.split(self.cmdline)
         with open(self.logfile, "a") as logfile:
-            self.process = subprocess.Popen(args, stdout=logfile, stderr=logfile, cwd=self.work_dir, shell=False)
+            # in a new process group, such that the server and all its
+            # children can be killed as a unit
+            self.process = subprocess.Popen(args, stdout=logfile, stderr=logfile, cwd=self.work_dir, shell=False,
+                                            start_new_session=True)
             self.log.info(f"started server (pid={self.process.pid}) serving repos from {self.root_dir}")
         self.wait_until_ready()
 
@@ -98,11 +124,18 @@ class RepoServer(object):
 
     def stop(self):
         """
-        Terminate the background repo server process
+        Terminate the background repo server process and all its children
+        (killed if they do not terminate within STOP_TIMEOUT seconds)
         """
-        if self.process and self.process.poll() is None:
+        if self.process:
             self.log.info(f"killing server pid {self.process.pid}")
-            self.process.terminate()
+            run.kill_group(self.process, signal.SIGTERM)
+            try:
+                self.process.wait(timeout=self.STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.log.warn(f"server pid {self.process.pid} did not terminate, killing it")
+            # also kill children that outlived the server
+            run.kill_group(self.process)
             self.process.wait()
             self.process = None
 
@@ -131,26 +164,147 @@ class GitRepoServer(RepoServer):
     """
     VCS = "git"
 
-    def __init__(self, work_dir, logger=None, logfile=None):
-        super().__init__(work_dir, logger=logger, logfile=logfile)
+    # Standard port of git daemon
+    DEFAULT_PORT = 9418
+
+    URL_BASE = "git://localhost"
+
+    def __init__(self, work_dir, logger=None, logfile=None, metrics_interval=0.1, storage=None,
+                 max_request_time=300, watchdog_interval=1.0, port=DEFAULT_PORT):
+        """
+        :param metrics_interval:  Interval (in seconds) at which the daemon logfile
+                                  is parsed for metrics in the background
+                                  (None to parse only when metrics() is called)
+        :param max_request_time:  Max seconds a daemon child serving a request can
+                                  run before the watchdog kills it
+        :param watchdog_interval: Interval (in seconds) at which the watchdog checks
+                                  the daemon children (None to disable the watchdog)
+        :param port:              Port the daemon listens on (0 for a free port)
+        """
+        super().__init__(work_dir, logger=logger, logfile=logfile, storage=storage)
 
-        # Standard port is 9418
-        self.port = 9418
+        if not port:
+            port = free_port()
+        self.port = port
 
-        GitRepoServer.URL_BASE = f"git://localhost"
+        # Request metrics from the daemon logfile
+        self.daemon_log = GitDaemonLog(self.logfile)
+        self.metrics_interval = metrics_interval
+
+        # Watchdog reaping stray daemon children
+        self.max_request_time = max_request_time
+        self.watchdog_interval = watchdog_interval
+        self.watchdog_kills = 0
+        self._watchdog = None
+        self._watchdog_stop = threading.Event()
+
+        # URL base of this server (differs from the class default for non-standard ports)
+        if port != self.DEFAULT_PORT:
+            self.URL_BASE = f"git://localhost:{port}"
 
         self.cmdline = \
             f"git daemon --reuseaddr --port={self.port} --export-all --verbose --enable=receive-pack" + \
             f" --base-path=."
 
+    def atinit(self):
+        super().atinit()
+        # logfile was truncated
+        self.daemon_log.reset()
+
+    def start(self):
+        super().start()
+        if self.metrics_interval:
+            self.daemon_log.follow(self.metrics_interval)
+        if self.watchdog_interval:
+            self._watchdog_stop.clear()
+            self._watchdog = threading.Thread(target=self._watchdog_loop, name="git-daemon-watchdog", daemon=True)
+            self._watchdog.start()
+
+    def stop(self):
+        if self._watchdog:
+            self._watchdog_stop.set()
+            self._watchdog.join()
+            self._watchdog = None
+        super().stop()
+        self.daemon_log.unfollow()
+
+    def _watchdog_loop(self):
+        while not self._watchdog_stop.wait(self.watchdog_interval):
+            process = self.process
+            if process is None:
+                continue
+            if process.poll() is not None:
+                # the daemon died: kill children left in its process group
+                self.log.error(f"{self} daemon exited with {process.returncode}, killing its children")
+                run.kill_group(process)
+                return
+            try:
+                self.reap_stray_children()
+            except OSError as e:
+                # e.g. a process exited while /proc was read
+                self.log.debug(f"{self} watchdog: {e}")
+
+    def reap_stray_children(self, max_age=None):
+        """
+        Kill daemon children (and their descendants) serving requests for
+        longer than `max_age` seconds, e.g. upload-pack processes stuck on
+        a client that stopped reading (see run.process_tree() for the
+        processes of the server). Called periodically by the watchdog.
+
+        Only supported on Linux: does nothing without /proc (the watchdog
+        still kills the process group if the daemon dies).
+
+        :param max_age: seconds (default is max_request_time)
+        :return: list of killed pids
+        """
+        if max_age is None:
+            max_age = self.max_request_time
+        if not self.process or not os.path.exists("/proc/uptime"):
+            return []
+
+        tree = run.process_tree(self.process.pid)
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        ticks = os.sysconf("SC_CLK_TCK")
+
+        # children of the daemon process serve connections
+        daemon_pids = {pid for pid, fields in tree.items() if int(fields[1]) == self.process.pid}
+        stray = [pid for pid, fields in tree.items()
+                 if int(fields[1]) in daemon_pids and uptime - int(fields[19]) / ticks > max_age]
+
+        killed = []
+        for pid in stray:
+            for child in run.process_tree(pid):
+                try:
+                    os.kill(child, signal.SIGKILL)
+                    killed.append(child)
+                except ProcessLookupError:
+                    pass
+            self.log.warn(f"{self} watchdog killed daemon child pid {pid} running for more than {max_age}s")
+
+        self.watchdog_kills += len(stray)
+        return killed
+
+    def metrics(self):
+        """
+        Return snapshot of request metrics parsed from the daemon logfile,
+        in total and per repo: request count per service, number of active
+        and max concurrent requests, errors and request durations.
+
+        Repo keys are the paths as requested by clients, e.g. '/abc'
+
+        :return: dict, see GitDaemonLog.snapshot()
+        """
+        return self.daemon_log.snapshot()
+
     def wait_until_ready(self, timeout=2):
         # create an empty dummy repository that we can use for connection test
         dummy_repo_name = "dummy-repo.git"
         repo_dir = Path(self.root_dir) / f"{dummy_repo_name}"
         if not repo_dir.is_dir():
             repo_dir.mkdir(parents=True)
-            cmd = f"git --git-dir={repo_dir}/.git init --bare"
-            run.cmd_run(cmd, cwd=self.root_dir, assert_ok=True)
+            cmd = ["git", f"--git-dir={repo_dir}/.git", "init", "--bare"]
+            run.cmd_run(cmd, assert_ok=True)
 
         self.log.info(f"{self.VCS} server wait_until_ready()")
 
@@ -166,7 +320,7 @@ class GitRepoServer(RepoServer):
             self.log.info(f"Connected to {self.VCS} server in {elapsed:.1f}s")
         else:
             self.log.error("Oops, server exited. Here is the tail of the logfile:")
-            out = run.cmd_run_get_output(f"tail {self.logfile}")
+            out = run.cmd_run_get_output(["tail", str(self.logfile)])
             print(out)
             raise RepoServerError("Oops, cannot connect to reposerver process")
 
@@ -178,6 +332,48 @@ class GitRepoServer(RepoServer):
 
         # then make a proper request to make sure all is fine
         url = f"{self.URL_BASE}/{path}"
-        cmd = f"git ls-remote --heads {url}"
-        exitcode, _, _ = run.cmd_run(cmd)
+        exitcode, _, _ = run.cmd_run(["git", "ls-remote", "--heads", url])
         return exitcode == 0
+
+    def find_repos(self):
+        """
+        Return paths (relative to server root) of all repos on server
+
+        :return: sorted list of repo paths
+        """
+        repos = []
+        # repos can be symlinks, see TmpfsStorage
+        for dirpath, dirnames, _ in os.walk(self.root_dir, followlinks=True):
+            is_bare = {"objects", "refs"} <= set(dirnames)
+            if ".git" in dirnames or is_bare:
+                repos.append(os.path.relpath(dirpath, self.root_dir))
+                # do not descend into repos
+                dirnames.clear()
+
+        return sorted(repos)
+
+    def pack_maintenance(self, repos=None, jobs=None, **kwargs):
+        """
+        Run GitRepo.pack_maintenance() on repos on the server, in parallel
+
+        :param repos: repo paths (relative to server root), None for all repos
+        :param jobs: max number of repos to process in parallel (default is number of CPUs)
+        :param kwargs: keyword arguments passed to GitRepo.pack_maintenance()
+        :return: list of repo paths that were processed
+        """
+        if repos is None:
+            repos = self.find_repos()
+
+        self.log.info(f"{self} pack maintenance of {len(repos)} repos")
+        time_started = time.time()
+
+        def maintain(path):
+            GitRepo(str(Path(self.root_dir) / path), logger=self.log).pack_maintenance(**kwargs)
+
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+            # list() re-raises the first exception from any of the workers
+            list(executor.map(maintain, repos))
+
+        elapsed = time.time() - time_started
+        self.log.info(f"{self} pack maintenance done in {elapsed:.1f}s")
+        return repos
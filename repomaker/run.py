@@ -1,45 +1,292 @@
+import os
+import shlex
+import shutil
+import signal
 import subprocess
 import sys
+import threading
 
 
-def cmd_run(cmd: str, cwd=None, assert_ok=False, logger=None):
+# Environment of all commands (computed on first use, see cmd_env())
+_env = None
+
+# Cache of absolute paths of executables
+_executables = {}
+
+
+def cmd_env(refresh=False):
+    """
+    Return the environment used for all commands: the environment of this
+    process with the C locale (such that git messages can be parsed) and
+    no interactive git credential prompts.
+
+    It is computed once, call with `refresh` True after changing os.environ.
+
+    :param refresh: True to recompute the environment
+    :return: dict
+    """
+    global _env
+    if _env is None or refresh:
+        env = dict(os.environ)
+        env.update(LC_ALL="C", LANGUAGE="", GIT_TERMINAL_PROMPT="0")
+        _env = env
+    return _env
+
+
+class CmdCancelled(Exception):
+    """Command was cancelled with CancelToken.cancel()"""
+
+
+class CancelToken(object):
+    """
+    Token for cancelling commands from another thread.
+
+    All commands run with the token are killed when cancel() is called
+    (with their process group if they were started in one), and commands
+    started after that are cancelled immediately.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        # running process -> True if it is leader of a new process group
+        self._procs = {}
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """
+        Kill all commands running with this token
+        """
+        with self._lock:
+            self.cancelled = True
+            procs = list(self._procs.items())
+        for proc, group in procs:
+            _kill(proc, group)
+
+    def _add(self, proc, group):
+        with self._lock:
+            self._procs[proc] = group
+            cancelled = self.cancelled
+        if cancelled:
+            _kill(proc, group)
+
+    def _remove(self, proc):
+        with self._lock:
+            self._procs.pop(proc, None)
+
+
+def kill_group(proc, sig=signal.SIGKILL):
+    """
+    Send signal `sig` to the process group of `proc`, which must have been
+    started as leader of a new process group (start_new_session=True).
+    The group is signalled even if `proc` has already exited.
+
+    :param proc: subprocess.Popen instance
+    :param sig: signal to send
+    """
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _kill(proc, group):
+    """Kill `proc`, with its process group if `group` is True"""
+    if group:
+        kill_group(proc)
+    elif proc.poll() is None:
+        proc.kill()
+
+
+def proc_stat(pid):
+    """
+    Return fields of /proc/`pid`/stat after the command name (field 3 onwards)
+    or None if the process does not exist. Only supported on Linux.
+
+    Useful fields are [1] ppid, [2] pgrp, [11:15] utime, stime, cutime,
+    cstime and [19] starttime (in clock ticks after boot)
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+
+    # the command name is in parentheses and may contain spaces
+    return stat.rsplit(")", 1)[1].split()
+
+
+def process_tree(pid):
+    """
+    Return dict of pid -> proc_stat() of process `pid` and all its
+    live descendants. Only supported on Linux (empty dict without /proc).
+
+    E.g. the tree of a git server started as "git daemon" is the "git"
+    process that was started, the daemon (its child) and a child of the
+    daemon per connection.
+
+    :param pid: process id
+    """
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return {}
+
+    # map of ppid -> child pids for all processes
+    children = {}
+    stats = {}
+    for entry in entries:
+        if entry.isdigit():
+            fields = proc_stat(entry)
+            if fields:
+                stats[int(entry)] = fields
+                children.setdefault(int(fields[1]), []).append(int(entry))
+
+    tree = {}
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        if pid in stats:
+            tree[pid] = stats[pid]
+            pids.extend(children.get(pid, []))
+
+    return tree
+
+
+def cmd_str(cmd):
+    """
+    Return command `cmd` (string or argv list) as a string suitable for logging
+    """
+    if isinstance(cmd, str):
+        return cmd
+    return " ".join(shlex.quote(arg) for arg in cmd)
+
+
+def _popen_args(cmd, cwd, new_group=False):
+    """
+    Return keyword arguments for subprocess.Popen() for command `cmd`.
+
+    A string `cmd` is run by the shell. An argv list is run without shell,
+    with the executable resolved to its absolute path, the precomputed
+    environment and file descriptors left open (Python creates them
+    non-inheritable), which lets subprocess use posix_spawn() instead of
+    fork() and exec() when `cwd` is None and `new_group` is False.
+
+    If `new_group` is True, the command is started in a new process group,
+    such that it can be killed together with its child processes.
+    """
+    if isinstance(cmd, str):
+        return dict(args=cmd, shell=True, cwd=cwd, start_new_session=new_group)
+
+    executable = _executables.get(cmd[0])
+    if executable is None:
+        executable = shutil.which(cmd[0]) or cmd[0]
+        _executables[cmd[0]] = executable
+
+    return dict(args=cmd, executable=executable, cwd=cwd, env=cmd_env(), close_fds=False,
+                start_new_session=new_group)
+
+
+def _new_group(cmd, timeout, cancel):
+    """
+    Return True if `cmd` must be started in a new process group: if it can
+    time out, or if it can be cancelled and is run by the shell (which
+    may not exec the last command and thus leave it running when killed)
+    """
+    return timeout is not None or (cancel is not None and isinstance(cmd, str))
+
+
+def cmd_popen(cmd, cwd=None, logger=None, **kwargs):
+    """
+    Start `cmd` in directory `cwd` as a background process and return
+    the subprocess.Popen instance, e.g. for long-lived processes that are
+    fed requests on stdin.
+
+    :param cmd: command to run (argv list or shell command string)
+    :param cwd: directory in which to run the command
+    :param logger:
+    :param kwargs: additional subprocess.Popen() arguments, e.g. stdin
+    :return: subprocess.Popen instance
+    """
+    if logger:
+        logger.shell(cmd_str(cmd))
+
+    return subprocess.Popen(**_popen_args(cmd, cwd), **kwargs)
+
+
+def cmd_run(cmd, cwd=None, assert_ok=False, logger=None, input=None, timeout=None, cancel=None):
     """
     Run `cmd` in directory `cwd` and return complete result
 
+    `cmd` is either an argv list, which is executed directly, or a string,
+    which is executed by the shell.
+
+    If `timeout` is given (or `cancel` for a shell command), the command is
+    started in a new process group, which is killed as a unit on timeout or
+    cancellation. Otherwise only the command itself is killed on
+    cancellation (a new process group prevents the use of posix_spawn(),
+    which makes short commands slower).
+
     The command is printed/logged if log.verbose >= 1.
 
-    :param cmd: command to run
+    :param cmd: command to run (argv list or shell command string)
     :param cwd: directory in which to run the command
     :param assert_ok:
     :param logger:
+    :param input: string to pass on stdin of the command
+    :param timeout: max seconds the command can run
+    :param cancel: CancelToken instance
+    :raise subprocess.TimeoutExpired: if command timed out
+    :raise CmdCancelled: if command was cancelled
     :return:
     """
     if logger:
-        logger.shell(cmd)
+        logger.shell(cmd_str(cmd))
+
+    new_group = _new_group(cmd, timeout, cancel)
 
     # Using universal_newlines=True converts the output to a string instead of a byte array
     # Python 3.7 has the more intuitive text=True instead of universal_newlines
-    proc = subprocess.run(cmd, shell=True, cwd=cwd,
-                       universal_newlines=True, encoding="utf8",
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    proc = subprocess.Popen(**_popen_args(cmd, cwd, new_group),
+                            universal_newlines=True, encoding="utf8",
+                            stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if cancel:
+        cancel._add(proc, new_group)
+    try:
+        out, err = proc.communicate(input, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_group(proc)
+        out, err = proc.communicate()
+        raise subprocess.TimeoutExpired(cmd_str(cmd), timeout, output=out, stderr=err)
+    except BaseException:
+        _kill(proc, new_group)
+        proc.wait()
+        raise
+    finally:
+        if cancel:
+            cancel._remove(proc)
+
+    if cancel and cancel.cancelled and proc.returncode < 0:
+        raise CmdCancelled(f"'{cmd_str(cmd)}' was cancelled")
+
     if assert_ok and proc.returncode != 0:
         if logger:
-            logger.error(proc.stderr)
+            logger.error(err)
         else:
-            print(proc.stderr, file=sys.stderr)
+            print(err, file=sys.stderr)
         exit(1)
 
-    return proc.returncode, proc.stdout, proc.stderr
+    return proc.returncode, out, err
 
 
-def cmd_run_get_output(cmd: str, cwd=None, logger=None, splitlines=False):
+def cmd_run_get_output(cmd, cwd=None, logger=None, splitlines=False):
     """
     Run `cmd` in directory `cwd` and return output stripped for newline
 
     If `splitlines` is True, multiline output is expected and output will be a
     list of lines (without newline character)
 
-    :param cmd: command to run
+    :param cmd: command to run (argv list or shell command string)
     :param cwd: directory in which to run the command
     :param logger:
     :param splitlines: True to return lines as a list
@@ -51,3 +298,96 @@ def cmd_run_get_output(cmd: str, cwd=None, logger=None, splitlines=False):
         return out.splitlines()
 
     return out.strip()
+
+
+def cmd_stream(cmd, cwd=None, logger=None, sep="\n", bufsize=65536, input=None,
+               timeout=None, cancel=None):
+    """
+    Run `cmd` in directory `cwd` and yield its output records (separated
+    by `sep`) as they are produced.
+
+    Closing the generator before all output is read terminates the command.
+
+    :param cmd: command to run (argv list or shell command string)
+    :param cwd: directory in which to run the command
+    :param logger:
+    :param sep: record separator, e.g. "\\0" for output of git commands run with -z
+    :param bufsize: max number of bytes to read at a time
+    :param input: string to pass on stdin of the command
+    :param timeout: max seconds the command can run
+    :param cancel: CancelToken instance
+    :raise subprocess.CalledProcessError: if command fails
+    :raise subprocess.TimeoutExpired: if command timed out
+    :raise CmdCancelled: if command was cancelled
+    """
+    if logger:
+        logger.shell(cmd_str(cmd))
+
+    new_group = _new_group(cmd, timeout, cancel)
+    proc = subprocess.Popen(**_popen_args(cmd, cwd, new_group),
+                            stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    timer = None
+    timed_out = threading.Event()
+    if timeout is not None:
+        def on_timeout():
+            timed_out.set()
+            kill_group(proc)
+        timer = threading.Timer(timeout, on_timeout)
+        timer.daemon = True
+        timer.start()
+    if cancel:
+        cancel._add(proc, new_group)
+
+    if input is not None:
+        # write from a thread such that a command producing output before
+        # reading all its input cannot deadlock
+        def write_input():
+            try:
+                proc.stdin.write(input.encode("utf8", errors="surrogateescape"))
+                proc.stdin.close()
+            except OSError:
+                pass
+        threading.Thread(target=write_input, daemon=True).start()
+
+    # read stderr from a thread such that a command writing more than the
+    # pipe buffer to stderr before finishing stdout cannot deadlock
+    err_chunks = []
+    err_reader = threading.Thread(target=lambda: err_chunks.extend(iter(proc.stderr.read1, b"")),
+                                  daemon=True)
+    err_reader.start()
+
+    sep = sep.encode()
+    try:
+        pending = b""
+        while True:
+            chunk = proc.stdout.read1(bufsize)
+            if not chunk:
+                break
+            records = (pending + chunk).split(sep)
+            pending = records.pop()
+            for record in records:
+                yield record.decode("utf8", errors="surrogateescape")
+        if pending:
+            yield pending.decode("utf8", errors="surrogateescape")
+    finally:
+        if timer:
+            timer.cancel()
+        if cancel:
+            cancel._remove(proc)
+        if proc.poll() is None:
+            _kill(proc, new_group)
+        proc.stdout.close()
+        proc.wait()
+        err_reader.join()
+        err = b"".join(err_chunks).decode("utf8", errors="replace")
+        proc.stderr.close()
+
+    if proc.returncode < 0:
+        if cancel and cancel.cancelled:
+            raise CmdCancelled(f"'{cmd_str(cmd)}' was cancelled")
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd_str(cmd), timeout, stderr=err)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd_str(cmd), stderr=err)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Resident repomaker service listening on a Unix socket
+
+Shell based test suites that build repos many times would otherwise pay
+Python interpreter startup, imports and git server startup for every build.
+The service keeps build scripts imported, runs builds on a pool of worker
+threads and keeps GitRepoServer instances running across requests.
+
+The client is the top-level module repomaker_client, which does not
+import the repomaker package. This module takes the same commands, plus
+"run" to run the service in the foreground. Example:
+
+    python3 -m repomaker_client start
+    python3 -m repomaker_client serve /tmp/reposerver
+    python3 -m repomaker_client build example.py make_repo_abc /tmp/reposerver abc
+    python3 -m repomaker_client reset /tmp/reposerver
+    python3 -m repomaker_client stop
+
+The protocol is one JSON request line answered by one JSON response line,
+e.g. {"op": "serve", "root": "/tmp/reposerver"} is answered by
+{"ok": true, "result": "git://localhost"}
+"""
+import importlib.util
+import json
+import os
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from repomaker_client import ServiceClient, ServiceError, parser_create, run_client
+
+from .log import Log
+from .repo.baserepo import BaseRepo
+from .reposerver import GitRepoServer
+
+
+class RepoService(object):
+    """
+    Handles service requests. Each op_<name>() method implements request
+    with "op" equal to <name>, and its keyword arguments are the other
+    keys of the request.
+    """
+
+    def __init__(self, jobs=None, logger=None):
+        """
+        :param jobs: number of builds that can run in parallel (default is number of CPUs)
+        :param logger: Log instance
+        """
+        self.log = logger or Log(level=0)
+
+        # pool of build workers
+        self.executor = ThreadPoolExecutor(max_workers=jobs or os.cpu_count())
+
+        # imported build scripts: path -> (mtime, module)
+        self.modules = {}
+        self.modules_lock = threading.Lock()
+
+        # running servers: root dir -> GitRepoServer
+        self.servers = {}
+        self.servers_lock = threading.Lock()
+
+        # set when service should exit
+        self.shutdown_event = threading.Event()
+
+    def handle(self, request):
+        """
+        Handle `request` dict and return response dict
+        """
+        op = request.pop("op", None)
+        method = getattr(self, f"op_{op}", None)
+        if not method:
+            return {"ok": False, "error": f"unknown op '{op}'"}
+
+        try:
+            result = method(**request)
+        except Exception as e:
+            self.log.error(f"{op} failed: {e}")
+            return {"ok": False, "error": f"{e.__class__.__name__}: {e}"}
+
+        return {"ok": True, "result": result}
+
+    def _load_module(self, path):
+        """
+        Return module of build script `path`, imported again only if changed
+        """
+        mtime = os.stat(path).st_mtime
+        with self.modules_lock:
+            cached = self.modules.get(path)
+            if cached and cached[0] == mtime:
+                return cached[1]
+
+            self.log.info(f"importing {path}")
+            name = f"repomaker_build_{len(self.modules)}"
+            spec = importlib.util.spec_from_file_location(name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self.modules[path] = (mtime, module)
+            return module
+
+    ###########################################################################
+    # Requests
+    ###########################################################################
+
+    def op_ping(self):
+        return os.getpid()
+
+    def op_status(self):
+        with self.servers_lock:
+            servers = {root: server.URL_BASE for root, server in self.servers.items()}
+        return {
+            "pid": os.getpid(),
+            "servers": servers,
+            "modules": sorted(self.modules),
+        }
+
+    def op_build(self, script, function, args=(), kwargs=None):
+        """
+        Call `function` in build script `script` on a build worker
+
+        :return: return value of function (repo path if it returns a repo)
+        """
+        def build():
+            module = self._load_module(os.path.abspath(script))
+            return getattr(module, function)(*args, **(kwargs or {}))
+
+        result = self.executor.submit(build).result()
+        if isinstance(result, BaseRepo):
+            return result.path
+        try:
+            json.dumps(result)
+        except TypeError:
+            return str(result)
+        return result
+
+    def op_serve(self, root):
+        """
+        Start server of repos in `root`, unless it is already running.
+        The first server listens on the standard port, further servers
+        (for other roots) on free ports.
+
+        :return: URL base of server
+        """
+        root = os.path.abspath(root)
+        with self.servers_lock:
+            server = self.servers.get(root)
+            if not server or not server.process or server.process.poll() is not None:
+                if server:
+                    server.stop()
+                ports = {s.port for r, s in self.servers.items() if r != root}
+                port = 0 if GitRepoServer.DEFAULT_PORT in ports else GitRepoServer.DEFAULT_PORT
+                server = GitRepoServer(root, logger=self.log, port=port)
+                server.start()
+                self.servers[root] = server
+            return server.URL_BASE
+
+    def op_reset(self, root):
+        """
+        Stop server of repos in `root` (if running) and delete all its repos
+        """
+        root = os.path.abspath(root)
+        with self.servers_lock:
+            server = self.servers.pop(root, None)
+            if server:
+                server.stop()
+            else:
+                server = GitRepoServer(root, logger=self.log)
+            server.delete_repos()
+
+    def op_metrics(self, root):
+        with self.servers_lock:
+            server = self.servers.get(os.path.abspath(root))
+        if not server:
+            raise ServiceError(f"no server running for {root}")
+        return server.metrics()
+
+    def op_shutdown(self):
+        self.shutdown_event.set()
+
+    def close(self):
+        with self.servers_lock:
+            for server in self.servers.values():
+                server.stop()
+            self.servers.clear()
+        self.executor.shutdown()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {"ok": False, "error": f"invalid request: {e}"}
+            else:
+                response = self.server.service.handle(request)
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve_forever(socket_path, jobs=None, logger=None):
+    """
+    Run service on `socket_path` until it receives a shutdown request
+    """
+    if ServiceClient(socket_path).is_running():
+        raise ServiceError(f"service is already running on {socket_path}")
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    service = RepoService(jobs=jobs, logger=logger)
+    with _UnixServer(socket_path, _RequestHandler) as server:
+        server.service = service
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        service.log.info(f"repomaker service (pid={os.getpid()}) listening on {socket_path}")
+        try:
+            service.shutdown_event.wait()
+        except KeyboardInterrupt:
+            pass
+        server.shutdown()
+
+    service.close()
+    os.unlink(socket_path)
+
+
+def main():
+    parser = parser_create(run=True)
+    opt = parser.parse_args()
+    if not opt.command:
+        parser.error("a command is required")
+
+    if opt.command == "run":
+        serve_forever(opt.socket, jobs=opt.jobs)
+        return
+    run_client(opt)
+
+
+if __name__ == "__main__":
+    main()
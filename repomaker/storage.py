@@ -0,0 +1,228 @@
+"""
+tmpfs storage backend for throwaway repos
+"""
+import atexit
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from .log import Log
+from .repo.baserepo import RepoError, repo_instances, repo_lock
+
+
+class TmpfsStorage(object):
+    """
+    Place repos on a tmpfs (e.g. /dev/shm) within a memory budget.
+
+    A repo is allocated as a directory on the tmpfs and its path is made a
+    symlink to that directory, so the repo path stays the same wherever the
+    repo is stored. When the repos on the tmpfs exceed the budget, the
+    largest repos are moved (spilled) to a directory on disk and their
+    symlinks are repointed.
+
+    All repos are deleted when the storage is closed (at exit at the latest).
+    """
+
+    # Git config for throwaway repos: no fsync and no automatic gc
+    GIT_CONFIG = {
+        "core.fsync": "none",
+        "gc.auto": "0",
+    }
+
+    def __init__(self, budget=None, tmpfs_dir="/dev/shm", spill_dir=None,
+                 check_interval=1.0, logger=None):
+        """
+        :param budget:         max bytes of repos on the tmpfs (default is
+                               a quarter of the size of the tmpfs)
+        :param tmpfs_dir:      directory on a tmpfs
+        :param spill_dir:      directory on disk for repos exceeding the budget
+                               (default is in the system temp directory)
+        :param check_interval: min interval (in seconds) between budget checks
+        :param logger:         Log instance
+        """
+        if budget is None:
+            st = os.statvfs(tmpfs_dir)
+            budget = st.f_blocks * st.f_frsize // 4
+        self.budget = budget
+        self.check_interval = check_interval
+        self.log = logger or Log(level=-1)
+
+        self.root = tempfile.mkdtemp(prefix="repomaker-", dir=tmpfs_dir)
+        self.spill_root = tempfile.mkdtemp(prefix="repomaker-spill-", dir=spill_dir)
+
+        # repo path -> directory holding the repo (on tmpfs or spilled to disk)
+        self.allocations = {}
+        self.lock = threading.RLock()
+        self._counter = itertools.count()
+        self._last_check = 0.0
+
+        atexit.register(self.close)
+
+    def __str__(self):
+        return f"<{self.__class__.__name__} dir={self.root} budget={self.budget}>"
+
+    def allocate(self, path):
+        """
+        Allocate tmpfs directory for repo at `path` and make `path` a symlink to it
+
+        :param path: repo path (must not exist or be an empty directory)
+        :return: path of tmpfs directory
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            if path in self.allocations:
+                return self.allocations[path]
+
+            if os.path.isdir(path) and not os.path.islink(path):
+                if os.listdir(path):
+                    raise RepoError(f"cannot place {path} on tmpfs: directory is not empty")
+                os.rmdir(path)
+            elif os.path.lexists(path):
+                raise RepoError(f"cannot place {path} on tmpfs: path exists")
+
+            target = os.path.join(self.root, f"{next(self._counter)}-{os.path.basename(path)}")
+            os.mkdir(target)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.symlink(target, path)
+            self.allocations[path] = target
+            self.log.verb(f"{self} allocated {path} -> {target}")
+            return target
+
+    def is_allocated(self, path):
+        return os.path.abspath(path) in self.allocations
+
+    def release(self, path):
+        """
+        Delete repo at `path` and its symlink
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            target = self.allocations.pop(path, None)
+        if target is None:
+            return
+        self._close_processes(path)
+        if os.path.islink(path):
+            os.unlink(path)
+        shutil.rmtree(target, ignore_errors=True)
+
+    def release_under(self, directory):
+        """
+        Delete all repos below `directory`
+        """
+        prefix = os.path.join(os.path.abspath(directory), "")
+        with self.lock:
+            paths = [p for p in self.allocations if p.startswith(prefix)]
+        for path in paths:
+            self.release(path)
+
+    def configure(self, repo):
+        """
+        Write git config suitable for throwaway repos to `repo`
+        """
+        for key, value in self.GIT_CONFIG.items():
+            repo.config_write(key, value)
+
+    @staticmethod
+    def _disk_usage(directory):
+        """Return bytes allocated by files in `directory`"""
+        usage = 0
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for name in filenames:
+                try:
+                    usage += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+                except OSError:
+                    pass
+        return usage
+
+    def usage(self):
+        """
+        Return dict of repo path -> bytes used, for repos on the tmpfs
+        """
+        with self.lock:
+            on_tmpfs = {p: t for p, t in self.allocations.items() if t.startswith(self.root)}
+        return {p: self._disk_usage(t) for p, t in on_tmpfs.items()}
+
+    def enforce_budget(self, force=False):
+        """
+        Spill the largest repos to disk until the repos on the tmpfs are
+        within the budget. Repos that are locked by another thread are skipped.
+
+        Unless `force` is True, this is only done if `check_interval`
+        seconds have passed since the last check.
+
+        :return: list of paths of spilled repos
+        """
+        now = time.time()
+        if not force and now - self._last_check < self.check_interval:
+            return []
+        self._last_check = now
+
+        usage = self.usage()
+        total = sum(usage.values())
+        spilled = []
+        for path, size in sorted(usage.items(), key=lambda item: -item[1]):
+            if total <= self.budget:
+                break
+            if self.spill(path, blocking=False):
+                spilled.append(path)
+                total -= size
+
+        return spilled
+
+    def spill(self, path, blocking=True):
+        """
+        Move repo at `path` from tmpfs to disk
+
+        :param path: repo path
+        :param blocking: False to give up if the repo is locked by another thread
+        :return: True if repo was moved
+        """
+        path = os.path.abspath(path)
+        lock = repo_lock(path)
+        if not lock.acquire(blocking=blocking):
+            return False
+        try:
+            with self.lock:
+                target = self.allocations.get(path)
+                if target is None or not target.startswith(self.root):
+                    return False
+                spill_target = os.path.join(self.spill_root, os.path.basename(target))
+
+            # persistent processes (e.g. 'git cat-file --batch') would keep
+            # working in the deleted tmpfs directory
+            self._close_processes(path)
+            shutil.copytree(target, spill_target, symlinks=True)
+            # atomically repoint symlink
+            tmp_link = f"{path}.repomaker-spill"
+            os.symlink(spill_target, tmp_link)
+            os.replace(tmp_link, path)
+            with self.lock:
+                self.allocations[path] = spill_target
+            # processes restarted by queries (which do not take the repo lock)
+            # during the copy still work in the tmpfs directory
+            self._close_processes(path)
+            shutil.rmtree(target)
+            self.log.info(f"{self} spilled {path} to {spill_target}")
+            return True
+        finally:
+            lock.release()
+
+    @staticmethod
+    def _close_processes(path):
+        """Terminate persistent processes of all instances of the repo at `path`"""
+        for repo in repo_instances(path):
+            repo.close_processes()
+
+    def close(self):
+        """
+        Delete all repos and storage directories
+        """
+        with self.lock:
+            paths = list(self.allocations)
+        for path in paths:
+            self.release(path)
+        shutil.rmtree(self.root, ignore_errors=True)
+        shutil.rmtree(self.spill_root, ignore_errors=True)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Client of the resident repomaker service (see repomaker.service)
+
+This module only uses the standard library and does not import the
+repomaker package, such that shell scripts calling it many times only pay
+Python interpreter startup.
+
+Example:
+
+    python3 -m repomaker_client start
+    python3 -m repomaker_client serve /tmp/reposerver
+    python3 -m repomaker_client build example.py make_repo_abc /tmp/reposerver abc
+    python3 -m repomaker_client reset /tmp/reposerver
+    python3 -m repomaker_client stop
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+
+def default_socket_path():
+    """
+    Return default path of the service socket
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "repomaker.sock")
+    return f"/tmp/repomaker-{os.getuid()}.sock"
+
+
+class ServiceError(Exception):
+    """Service exception"""
+
+
+class ServiceClient(object):
+    """
+    Client of the repomaker service
+    """
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or default_socket_path()
+
+    def request(self, op, **kwargs):
+        """
+        Send request `op` with arguments `kwargs` and return result
+
+        :raise ServiceError: if request failed
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(dict(op=op, **kwargs)).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline())
+
+        if not response["ok"]:
+            raise ServiceError(response["error"])
+        return response["result"]
+
+    def is_running(self):
+        try:
+            self.request("ping")
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def start(self, jobs=None, logfile=None, timeout=10):
+        """
+        Start the service as a background process (if not already running)
+        """
+        if self.is_running():
+            return
+
+        cmd = [sys.executable, "-m", "repomaker.service", "--socket", self.socket_path, "run"]
+        if jobs:
+            cmd += ["--jobs", str(jobs)]
+        # the repomaker package is installed next to this module
+        env = dict(os.environ)
+        paths = [os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH")]
+        env["PYTHONPATH"] = os.pathsep.join(path for path in paths if path)
+        logfile = logfile or f"{self.socket_path}.log"
+        with open(logfile, "a") as f:
+            subprocess.Popen(cmd, stdout=f, stderr=f, stdin=subprocess.DEVNULL, env=env,
+                             start_new_session=True)
+
+        deadline = time.time() + timeout
+        while not self.is_running():
+            if time.time() > deadline:
+                raise ServiceError(f"service did not start, see {logfile}")
+            time.sleep(0.05)
+
+
+def _parse_value(s):
+    """Parse CLI argument as JSON, falling back to plain string"""
+    try:
+        return json.loads(s)
+    except ValueError:
+        return s
+
+
+def parser_create(run=False):
+    """
+    :param run: True to add the "run" command (only available in repomaker.service)
+    """
+    description = ("Resident repomaker service and its client.\n" if run else
+                   "Client of the resident repomaker service.\n") + """
+Builds are done by calling a function in a Python build script, e.g.
+make_repo_abc() in example.py. Arguments are parsed as JSON if possible
+(else passed as strings) and name=value arguments are passed as keyword
+arguments. Use absolute paths in arguments as the service does not run in
+the directory of the client.
+"""
+    parser = argparse.ArgumentParser(
+        description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', default=default_socket_path(),
+                        help="Service socket path (default %(default)s)")
+    # (required=True needs Python 3.7, the command is checked in main())
+    sub = parser.add_subparsers(dest="command")
+
+    if run:
+        p = sub.add_parser("run", help="Run service in foreground")
+        p.add_argument('-j', '--jobs', type=int, help="Number of parallel builds")
+    p = sub.add_parser("start", help="Start service in background")
+    p.add_argument('-j', '--jobs', type=int, help="Number of parallel builds")
+    sub.add_parser("stop", help="Stop service")
+    sub.add_parser("status", help="Show service status")
+    p = sub.add_parser("build", help="Call build function in build script")
+    p.add_argument('script', help="Python build script")
+    p.add_argument('function', help="Build function in script")
+    p.add_argument('args', nargs="*", help="Function arguments")
+    p = sub.add_parser("serve", help="Start server of repos in ROOT (if not running)")
+    p.add_argument('root')
+    p = sub.add_parser("reset", help="Stop server of repos in ROOT and delete the repos")
+    p.add_argument('root')
+    p = sub.add_parser("metrics", help="Show request metrics of server of repos in ROOT")
+    p.add_argument('root')
+
+    return parser
+
+
+def run_client(opt):
+    """
+    Run client command of parsed arguments `opt` and print its result
+    """
+    client = ServiceClient(opt.socket)
+    try:
+        if opt.command == "start":
+            client.start(jobs=opt.jobs)
+            return
+        if opt.command == "stop":
+            if client.is_running():
+                client.request("shutdown")
+            return
+
+        if opt.command == "build":
+            args, kwargs = [], {}
+            for arg in opt.args:
+                name, sep, value = arg.partition("=")
+                if sep and name.isidentifier():
+                    kwargs[name] = _parse_value(value)
+                else:
+                    args.append(_parse_value(arg))
+            result = client.request("build", script=os.path.abspath(opt.script),
+                                    function=opt.function, args=args, kwargs=kwargs)
+        elif opt.command in ("serve", "reset", "metrics"):
+            result = client.request(opt.command, root=os.path.abspath(opt.root))
+        else:
+            result = client.request(opt.command)
+    except (OSError, ServiceError) as e:
+        print(f"repomaker service: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if result is not None:
+        print(result if isinstance(result, str) else json.dumps(result, indent=2))
+
+
+def main():
+    parser = parser_create()
+    opt = parser.parse_args()
+    if not opt.command:
+        parser.error("a command is required")
+    run_client(opt)
+
+
+if __name__ == "__main__":
+    main()